@@ -0,0 +1,37 @@
+import pandas as pd
+from sql_queries import top_artists_select, top_artists_level_select, top_matched_artists_select, \
+                        top_songs_select, user_plays_select, hour_weekday_plays_select
+
+# Dashboard queries served from the rollup tables that etl.py keeps up to date after every load.
+# They never scan the songplays/songplays_fill fact tables, so they answer in milliseconds.
+# Each function returns a pandas DF, e.g. from notebooks/analytic_dashboard.ipynb:
+#     results1 = top_artists(cur)
+#     results2 = top_artists(cur, level='paid')
+
+def query_df(cur, query, params=None):
+    """Run the query and return the results as a pandas DF with the query column names"""
+    cur.execute(query, params)
+    colnames = [desc[0] for desc in cur.description]
+    return pd.DataFrame(cur.fetchall(), columns=colnames)
+
+def top_artists(cur, limit=15, level=None):
+    """Top artists by number of plays (artist names from the log data), for all users or one level"""
+    if level is None:
+        return query_df(cur, top_artists_select, (limit,))
+    return query_df(cur, top_artists_level_select, (level, limit))
+
+def top_matched_artists(cur, limit=15):
+    """Top artists by number of plays, for the plays matched to the artists table (the README sample query)"""
+    return query_df(cur, top_matched_artists_select, (limit,))
+
+def top_songs(cur, limit=15):
+    """Top songs by number of plays"""
+    return query_df(cur, top_songs_select, (limit,))
+
+def user_plays(cur):
+    """Number of plays per user and level"""
+    return query_df(cur, user_plays_select)
+
+def hour_weekday_plays(cur):
+    """Number of plays per hour of the day and weekday (Monday=0)"""
+    return query_df(cur, hour_weekday_plays_select)
@@ -0,0 +1,290 @@
+import os
+import json
+import random
+import string
+import shutil
+import argparse
+import tempfile
+import subprocess
+import datetime
+from contextlib import contextmanager
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extensions import make_dsn, parse_dsn
+import sql_queries
+import create_tables
+import etl
+import metrics
+
+# Pages of the non NextSong log events, with their (rough) weights in the sample log data
+other_pages = ["Home", "Logout", "Login", "Settings", "Help", "Upgrade", "Downgrade", "About", "Thumbs Up", \
+               "Thumbs Down", "Add to Playlist", "Add Friend", "Save Settings", "Error"]
+other_weights = [40, 9, 9, 2, 2, 1, 1, 1, 5, 1, 3, 2, 1, 1]
+
+user_agents = ['"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.36 (KHTML, like Gecko) ' \
+               'Chrome/36.0.1985.143 Safari/537.36"',
+               '"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) ' \
+               'Chrome/35.0.1916.153 Safari/537.36"',
+               'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:31.0) Gecko/20100101 Firefox/31.0']
+locations = ["San Francisco-Oakland-Hayward, CA", "Phoenix-Mesa-Scottsdale, AZ", "Portland-South Portland, ME", \
+             "Atlanta-Sandy Springs-Roswell, GA", "Lansing-East Lansing, MI", "Tampa-St. Petersburg-Clearwater, FL"]
+
+def random_id(rng, prefix):
+    """Random 18 character id in the Million Song Dataset style (e.g. TRAAAAW128F429D538)"""
+    return prefix + ''.join(rng.choice(string.ascii_uppercase + string.digits) for i in range(16))
+
+def random_words(rng, num_words):
+    """Random title-cased words for song titles and artist names"""
+    return ' '.join(''.join(rng.choice(string.ascii_lowercase) for i in range(rng.randint(3, 8))).title() \
+                    for i in range(num_words))
+
+def generate_song_data(datapath, num_songs, rng):
+    """
+    - Write num_songs song json files (one track per file) under datapath/song_data/X/Y/Z/
+    with the same fields as the Million Song Dataset subset
+    - Return the list of songs, used to build matching log events
+    """
+    artists = []
+    for i in range(max(1, num_songs // 2)):
+        has_coords = rng.random() < 0.4
+        artists.append({"artist_id": random_id(rng, "AR"),
+                        "artist_latitude": round(rng.uniform(-60, 60), 5) if has_coords else None,
+                        "artist_longitude": round(rng.uniform(-150, 150), 5) if has_coords else None,
+                        "artist_location": rng.choice(locations + [""]),
+                        "artist_name": random_words(rng, rng.randint(1, 3))})
+    songs = []
+    for i in range(num_songs):
+        track_id = random_id(rng, "TR")
+        song = {"num_songs": 1}
+        song.update(rng.choice(artists))
+        song.update({"song_id": random_id(rng, "SO"),
+                     "title": random_words(rng, rng.randint(1, 5)),
+                     "duration": round(rng.uniform(30, 600), 5),
+                     "year": rng.choice([0, rng.randint(1960, 2010)])})
+        songdir = os.path.join(datapath, 'song_data', track_id[2], track_id[3], track_id[4])
+        os.makedirs(songdir, exist_ok=True)
+        with open(os.path.join(songdir, track_id + '.json'), 'w') as f:
+            json.dump(song, f)
+        songs.append(song)
+    return songs
+
+def generate_log_data(datapath, num_events, songs, match_rate, num_days, rng):
+    """
+    - Write num_events log events, spread over num_days daily files under datapath/log_data/2018/11/
+    with the same fields as the event simulator logs
+    - About 80% of the events are NextSong, and match_rate of those match a song from songs
+    on (title, artist name, duration)
+    """
+    num_users = max(10, num_events // 500)
+    users = [{"userId": str(i), "firstName": random_words(rng, 1), "lastName": random_words(rng, 1), \
+              "gender": rng.choice("MF"), "level": rng.choice(["free", "paid"]), \
+              "location": rng.choice(locations), "userAgent": rng.choice(user_agents), \
+              "registration": float(rng.randint(1530000000000, 1540000000000))} for i in range(1, num_users + 1)]
+    logdir = os.path.join(datapath, 'log_data', '2018', '11')
+    os.makedirs(logdir, exist_ok=True)
+    day_start = datetime.datetime(2018, 11, 1)
+    session_id = 0
+    for day in range(num_days):
+        events_per_day = num_events // num_days + (1 if day < num_events % num_days else 0)
+        date = day_start + datetime.timedelta(days=day)
+        ts = int(date.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000)
+        step = max(1, 86400000 // max(1, events_per_day))
+        filename = os.path.join(logdir, date.strftime('%Y-%m-%d') + '-events.json')
+        with open(filename, 'w') as f:
+            for i in range(events_per_day):
+                # a new session every ~20 events, sometimes with a user changing level
+                if i % 20 == 0:
+                    session_id += 1
+                    item = 0
+                    user = rng.choice(users)
+                    if rng.random() < 0.05:
+                        user["level"] = "paid" if user["level"] == "free" else "free"
+                ts += rng.randint(1, step)
+                event = {"artist": None, "auth": "Logged In", "firstName": user["firstName"], \
+                         "gender": user["gender"], "itemInSession": item, "lastName": user["lastName"], \
+                         "length": None, "level": user["level"], "location": user["location"], "method": "PUT", \
+                         "page": "NextSong", "registration": user["registration"], "sessionId": session_id, \
+                         "song": None, "status": 200, "ts": ts, "userAgent": user["userAgent"], \
+                         "userId": user["userId"]}
+                if rng.random() < 0.8:
+                    if songs and rng.random() < match_rate:
+                        song = rng.choice(songs)
+                        event.update({"artist": song["artist_name"], "song": song["title"], \
+                                      "length": song["duration"]})
+                    else:
+                        event.update({"artist": random_words(rng, 2), "song": random_words(rng, 3), \
+                                      "length": round(rng.uniform(30, 600), 5)})
+                else:
+                    event.update({"page": rng.choices(other_pages, other_weights)[0], "method": "GET"})
+                    if event["page"] in ("Home", "Login", "About", "Help") and rng.random() < 0.2:
+                        # logged out events have no user
+                        event.update({"auth": "Logged Out", "firstName": None, "gender": None, \
+                                      "lastName": None, "location": None, "registration": None, \
+                                      "userAgent": None, "userId": "", "level": "free"})
+                f.write(json.dumps(event) + '\n')
+                item += 1
+
+def create_benchmark_database(dbname, bulk_load=False):
+    """
+    - Drop (if exists) and create the benchmark database, so the real sparkifydb is never touched
+    (parse_args refuses the databases of the dbstrings)
+    - Create all the tables (UNLOGGED without keys with bulk_load) and return the connection and cursor to it,
+    counting the round trips and bytes sent of each stage (see metrics.py)
+    """
+    conn = psycopg2.connect(sql_queries.dbstring_default)
+    conn.set_session(autocommit=True)
+    cur = conn.cursor()
+    cur.execute(sql.SQL("DROP DATABASE IF EXISTS {}").format(sql.Identifier(dbname)))
+    cur.execute(sql.SQL("CREATE DATABASE {} WITH ENCODING 'utf8' TEMPLATE template0").format(sql.Identifier(dbname)))
+    conn.close()
+
+    conn = psycopg2.connect(make_dsn(sql_queries.dbstring, dbname=dbname), \
+                            connection_factory=metrics.MetricsConnection)
+    cur = conn.cursor()
+    create_tables.create_tables(cur, conn, bulk_load=bulk_load)
+    return cur, conn
+
+@contextmanager
+def bench_step(steps, name):
+    """
+    One timed step of the benchmark, run as a metrics stage (see metrics.Recorder.stage), so the ETL stages
+    it runs (parse, transform, match, copy, upsert, quality check...) are recorded in it with their own
+    wall time, rows, bytes sent, round trips and memory peak.
+    The step fills in record['rows_out'], its throughput is added when it ends and it is appended to steps
+    """
+    with metrics.stage(name) as record:
+        yield record
+    wall = record["wall_s"]
+    num_rows = record["rows_out"]
+    record["rows_per_s"] = round(num_rows / wall, 1) if num_rows is not None and wall > 0 else None
+    steps.append(record)
+    print("{:<28} {:>10.3f} s {:>12} rows {:>14} rows/s".format(name, wall, str(num_rows), \
+          str(record["rows_per_s"])))
+
+def git_version():
+    """Short git commit of the code being benchmarked (unknown outside a git checkout)"""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], \
+                                       cwd=os.path.dirname(os.path.abspath(__file__)), \
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def parse_args():
+    """Command line options for the benchmark run"""
+    parser = argparse.ArgumentParser(description="Generate synthetic Sparkify data and time each ETL stage")
+    parser.add_argument('--events', type=int, default=10000, help="number of log events to generate")
+    parser.add_argument('--songs', type=int, default=None, help="number of song files (default: events / 10)")
+    parser.add_argument('--match-rate', type=float, default=0.5,
+                        help="fraction of NextSong events that match a generated song")
+    parser.add_argument('--days', type=int, default=30, help="number of daily log files")
+    parser.add_argument('--workers', type=int, default=etl.num_workers, help="number of parser processes")
+    parser.add_argument('--load-workers', type=int, default=1,
+                        help="load the tables concurrently on this many pooled connections (default: one by one)")
+    parser.add_argument('--bulk-load', action='store_true',
+                        help="create the tables in bulk load mode (see create_tables.py --bulk-load)")
+    parser.add_argument('--chunk-files', type=int, default=0, help="stream the log data this many files at a time")
+    parser.add_argument('--chunk-mb', type=int, default=0, help="stream the log data in chunks of this many MB")
+    parser.add_argument('--prefetch', type=int, default=etl.prefetch_depth,
+                        help="number of chunks parsed ahead of the loads in streaming mode")
+    parser.add_argument('--seed', type=int, default=42, help="random seed for the generated data")
+    parser.add_argument('--datadir', default=None, help="where to write the data (default: a temp folder)")
+    parser.add_argument('--keep-data', action='store_true', help="keep the generated data after the run")
+    parser.add_argument('--dbname', default='sparkifydb_bench', help="database to (re)create for the run")
+    parser.add_argument('--output', default='bench_results.jsonl',
+                        help="file the results are appended to, one JSON line per run")
+    args = parser.parse_args()
+    # the benchmark database is dropped first, so it can't be the ETL (or the default) database
+    if args.dbname in ('sparkifydb', parse_dsn(sql_queries.dbstring).get('dbname'), \
+                       parse_dsn(sql_queries.dbstring_default).get('dbname')):
+        parser.error("--dbname {} is not a benchmark database, it would be dropped".format(args.dbname))
+    return args
+
+def main():
+    """
+    - Generate the song_data and log_data trees at the requested scale
+    - Run each ETL step against a fresh benchmark database and time it, with the ETL stages it runs
+    - Append the results to the output file as one JSON line
+    """
+    args = parse_args()
+    num_songs = args.songs if args.songs is not None else max(1, args.events // 10)
+    datapath = args.datadir or tempfile.mkdtemp(prefix='sparkify_bench_')
+    rng = random.Random(args.seed)
+    steps = []
+
+    with bench_step(steps, "generate song_data") as record:
+        songs = generate_song_data(datapath, num_songs, rng)
+        record['rows_out'] = len(songs)
+    with bench_step(steps, "generate log_data") as record:
+        generate_log_data(datapath, args.events, songs, args.match_rate, args.days, rng)
+        record['rows_out'] = args.events
+    del songs
+
+    cur, conn = create_benchmark_database(args.dbname, args.bulk_load)
+    pool = None
+    if args.load_workers > 1:
+        pool = etl.create_pool(make_dsn(sql_queries.dbstring, dbname=args.dbname), args.load_workers)
+    song_path = os.path.join(datapath, 'song_data')
+    log_path = os.path.join(datapath, 'log_data')
+    with bench_step(steps, "parse song_data") as record:
+        df = etl.process_data(cur, conn, song_path, etl.process_json_files, workers=args.workers)
+        record['rows_out'] = len(df)
+
+    streaming = args.chunk_files > 0 or args.chunk_mb > 0
+    if pool is not None and not streaming:
+        # all the tables in one concurrent load, the songplays match waits for the songs and artists
+        with bench_step(steps, "parse log_data") as record:
+            log_df = etl.process_data(cur, conn, log_path, etl.process_json_files, workers=args.workers)
+            record['rows_out'] = len(log_df)
+        num_rows = len(df) + int((log_df['page'] == "NextSong").sum())
+        with bench_step(steps, "transform song/log data") as record:
+            loads = etl.song_table_loads(*etl.transform_song_data(df)) + \
+                    etl.log_table_loads(*etl.transform_log_data(cur, conn, log_df), depends_on=["songs", "artists"])
+            record['rows_out'] = len(df) + len(log_df)
+        with bench_step(steps, "load all tables") as record:
+            etl.load_tables(pool, loads)
+            record['rows_out'] = num_rows
+        del df, log_df, loads
+    else:
+        with bench_step(steps, "load songs/artists") as record:
+            etl.insert_song_data(cur, conn, df)
+            record['rows_out'] = len(df)
+        del df
+
+    if streaming:
+        log_files = etl.discover_files(log_path)
+        manifest_df = etl.find_new_files(cur, log_path, False)[1]
+        chunks = etl.read_log_pipeline(log_files, etl.process_json_files, args.chunk_files, args.workers, \
+                                       args.prefetch, chunk_mb=args.chunk_mb)
+        with bench_step(steps, "stream log_data") as record:
+            etl.stream_log_data(cur, conn, log_files, manifest_df, chunks, pool=pool)
+            record['rows_out'] = args.events
+    elif pool is None:
+        with bench_step(steps, "parse log_data") as record:
+            df = etl.process_data(cur, conn, log_path, etl.process_json_files, workers=args.workers)
+            record['rows_out'] = len(df)
+        with bench_step(steps, "load time/users/songplays/songplays_fill") as record:
+            record['rows_out'] = len(etl.insert_log_data(cur, conn, df)[2])
+    if pool is not None:
+        pool.closeall()
+    conn.close()
+
+    if not args.keep_data and args.datadir is None:
+        shutil.rmtree(datapath)
+    metrics.recorder.summary()
+
+    # stages: the records of the benchmark steps and of the ETL stages run in them, in the order they ended
+    record = {"version": git_version(),
+              "date": datetime.datetime.now().isoformat(timespec='seconds'),
+              "events": args.events, "songs": num_songs, "match_rate": args.match_rate, "days": args.days,
+              "workers": args.workers, "load_workers": args.load_workers, "bulk_load": args.bulk_load,
+              "chunk_files": args.chunk_files, "chunk_mb": args.chunk_mb, "prefetch": args.prefetch,
+              "total_wall_s": round(sum(step["wall_s"] for step in steps), 4),
+              "steps": [step["stage"] for step in steps],
+              "stages": metrics.recorder.records}
+    with open(args.output, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+    print("Results appended to {}".format(args.output))
+
+if __name__ == "__main__":
+    main()
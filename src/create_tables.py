@@ -1,6 +1,9 @@
-import os
+import argparse
 import psycopg2
-from sql_queries import create_table_queries, drop_table_queries, dbstring, dbstring_default
+from psycopg2 import sql
+from sql_queries import create_table_queries, drop_table_queries, partitioned_table_queries, dbstring, \
+                        dbstring_default, songplay_table_create, songplay_table_create_2, bulk_load_keys, \
+                        bulk_load_unique_keys, bulk_table_prepare, bulk_table_drop_unique
 
 
 def create_database():
@@ -40,13 +43,49 @@ def drop_tables(cur, conn):
         conn.commit()
 
 
-def create_tables(cur, conn):
+def create_tables(cur, conn, partitioned=False, bulk_load=False):
     """
     Creates each table using the queries in `create_table_queries` list. 
+    With partitioned=True, the songplays tables are partitioned by month on start_time 
+    and indexed (using the queries in `partitioned_table_queries` list). 
+    With bulk_load=True, the star schema tables are then prepared for a bulk load (see prepare_bulk_load).
     """
-    for query in create_table_queries:
+    queries = create_table_queries
+    if partitioned:
+        queries = [query for query in create_table_queries \
+                   if query not in (songplay_table_create, songplay_table_create_2)] + partitioned_table_queries
+    for query in queries:
         cur.execute(query)
         conn.commit()
+    if bulk_load:
+        prepare_bulk_load(cur, conn, partitioned)
+
+
+def prepare_bulk_load(cur, conn, partitioned=False):
+    """
+    Drops the primary key of each table in `bulk_load_keys` (and the natural key in `bulk_load_unique_keys`)
+    and makes it UNLOGGED, etl.py builds the keys back after the first COPY into the table.
+    Partitioned tables can't be UNLOGGED, so the partitioned songplays tables keep their keys.
+    """
+    for tablename in bulk_load_keys:
+        if partitioned and tablename in ("songplays", "songplays_fill"):
+            continue
+        if tablename in bulk_load_unique_keys:
+            cur.execute(sql.SQL(bulk_table_drop_unique).format(sql.Identifier(tablename), \
+                                                               sql.Identifier(bulk_load_unique_keys[tablename][0])))
+        cur.execute(sql.SQL(bulk_table_prepare).format(sql.Identifier(tablename), \
+                                                       sql.Identifier(tablename + '_pkey')))
+        conn.commit()
+
+
+def parse_args():
+    """Command line options for creating the tables"""
+    parser = argparse.ArgumentParser(description="Create (or reset) the sparkify database and tables")
+    parser.add_argument('--partitioned', action='store_true',
+                        help="partition the songplays tables by month on start_time, with BRIN/B-tree indexes")
+    parser.add_argument('--bulk-load', action='store_true',
+                        help="create the star schema tables UNLOGGED without keys, for a fast initial load")
+    return parser.parse_args()
 
 
 def main():
@@ -55,22 +94,18 @@ def main():
     - Establishes connection with the sparkify database and gets
     cursor to it.  
     - Drops all the tables.  
-    - Creates all tables needed. 
+    - Creates all tables needed (see --partitioned and --bulk-load). 
     - Closes the connection. 
-    - Create csv folder if doesn't already exist
     """
+    args = parse_args()
     cur, conn = create_database()
     
     drop_tables(cur, conn)
-    create_tables(cur, conn)
+    create_tables(cur, conn, partitioned=args.partitioned, bulk_load=args.bulk_load)
     print("sparkifydb tables created")
     
     cur.close()
     conn.close()
     
-    if os.path.isdir('data/csv_files') == False:
-        os.mkdir('data/csv_files')
-        print("csv_files path created") 
-    
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,220 +1,920 @@
 import os
-import glob
+import io
+import queue
+import argparse
+import hashlib
+import threading
+import itertools
+import collections
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import psycopg2
+import psycopg2.pool
 from psycopg2 import sql
 import pandas as pd
 # Disable pandas SettingWithCopyWarning 
 pd.options.mode.chained_assignment = None  # default='warn'
 from sql_queries import *
+import metrics
+import parse_cache
+from json_files import json_schema_version, process_json_files, concat_frames, discover_files
 
-def process_json_file(cur, filepath):
-    """Read each json file into a pandas dataframe"""
-    df_temp = pd.read_json(filepath, lines=True)
-    return df_temp
-    
-def insert_song_data(cur, conn, df, csvpath):
+# Number of rows sent per COPY FROM STDIN chunk (keeps client memory bounded on large batches)
+copy_chunksize = 50000
+# Number of processes used to parse the json files (can be changed with --workers)
+num_workers = os.cpu_count() or 1
+# Number of tables loaded concurrently, each on its own pooled connection (can be changed with --load-workers)
+load_workers = 6
+# Number of parsed log chunks queued ahead of the loads in streaming mode (can be changed with --prefetch)
+prefetch_depth = 2
+# Number of song files (one song each) per chunk in streaming mode without --chunk-mb
+song_chunk_files = 10000
+
+def copy_df(cur, df, copy_query, chunksize=copy_chunksize):
+    """
+    - Stream the df rows to Postgres with COPY FROM STDIN
+    - Rows are written as CSV into an in-memory buffer, chunksize rows at a time,
+    so no intermediate files are needed and memory stays bounded
+    """
+    for start in range(0, len(df), chunksize):
+        buf = io.StringIO()
+        df.iloc[start:start + chunksize].to_csv(buf, index=False, header=False)
+        buf.seek(0)
+        cur.copy_expert(copy_query, buf)
+
+def bulk_load_table(cur, tablename):
+    """Check if tablename is waiting for its bulk load (UNLOGGED, see create_tables.py --bulk-load)"""
+    if tablename not in bulk_load_keys:
+        return False
+    cur.execute(bulk_table_select, (tablename,))
+    return cur.fetchone()[0]
+
+def bulk_dedupe(cur, table, columns):
+    """Delete the rows of table that repeat the key columns of an earlier row, return the number of rows deleted"""
+    cur.execute(sql.SQL(bulk_table_dedupe).format( \
+        table=table, a_key=sql.SQL(', ').join(sql.SQL('a.{}').format(sql.Identifier(col)) for col in columns), \
+        b_key=sql.SQL(', ').join(sql.SQL('b.{}').format(sql.Identifier(col)) for col in columns)))
+    return cur.rowcount
+
+def bulk_copy_df_to_table(cur, conn, df, tablename):
+    """
+    - Stream the df straight into the UNLOGGED tablename with COPY FROM STDIN (no temp table, no index)
+    - Delete the duplicate keys in one set-based pass per key (natural key first, if the table has one),
+    build the keys and switch the table to LOGGED, then commit.
+    The whole load is one transaction, and the next loads use the upserts
+    """
+    table = sql.Identifier(tablename)
+    key = sql.Identifier(bulk_load_keys[tablename])
+    with metrics.stage("copy " + tablename, rows_in=len(df)) as record:
+        copy_df(cur, df, sql.SQL(bulk_table_copy).format(table).as_string(cur))
+        record['rows_out'] = len(df)
+    with metrics.stage("build " + tablename, rows_in=len(df)) as record:
+        deleted = 0
+        if tablename in bulk_load_unique_keys:
+            constraint, columns = bulk_load_unique_keys[tablename]
+            deleted += bulk_dedupe(cur, table, columns)
+            cur.execute(sql.SQL(bulk_table_add_unique).format(table, sql.Identifier(constraint), \
+                                                              sql.SQL(', ').join(map(sql.Identifier, columns))))
+        deleted += bulk_dedupe(cur, table, [bulk_load_keys[tablename]])
+        record['rows_out'] = len(df) - deleted
+        cur.execute(sql.SQL(bulk_table_finish).format(table, key))
+        conn.commit()
+
+def copy_df_to_table(cur, conn, df, tablename, insert_query):
+    """
+    - Create a temp table shaped like tablename
+    - Stream the df into the temp table with COPY FROM STDIN
+    - Transfer the rows to the final table (using insert_query from sql_queries.py), then commit
+    - In bulk load mode, the first load of tablename is a direct COPY instead (see bulk_copy_df_to_table)
+    """
+    if bulk_load_table(cur, tablename):
+        bulk_copy_df_to_table(cur, conn, df, tablename)
+        return
+    with metrics.stage("copy " + tablename, rows_in=len(df)) as record:
+        cur.execute(sql.SQL(tmp_table_create).format(sql.Identifier(tablename)))
+        copy_df(cur, df, tmp_table_copy)
+        record['rows_out'] = len(df)
+    with metrics.stage("upsert " + tablename, rows_in=len(df)) as record:
+        cur.execute(insert_query)
+        record['rows_out'] = cur.rowcount
+        conn.commit()
+
+def transform_song_data(df):
+    """Create the song and artist DFs from all the song data"""
+    with metrics.stage("transform song_data", rows_in=len(df)) as record:
+        # Create song DF from ALL song files
+        song_df = df[['song_id', 'title', 'artist_id', 'year', 'duration']]
+        # Sort by song title
+        song_df = song_df.sort_values('title')
+
+        # Create artist DF from ALL song files
+        artist_df = df[['artist_id', 'artist_name', 'artist_location', 'artist_latitude', 'artist_longitude']]
+        # Sort by artist_name
+        artist_df = artist_df.sort_values('artist_name')
+        record['rows_out'] = len(song_df) + len(artist_df)
+    return song_df, artist_df
+
+def song_table_loads(song_df, artist_df):
+    """Table loads for a batch of song data (see load_tables): songs and artists, independent of each other"""
+    return [("songs", copy_df_to_table, (song_df, "songs", song_table_insert), ()),
+            ("artists", copy_df_to_table, (artist_df, "artists", artist_table_insert), ())]
+
+def insert_song_data(cur, conn, df):
     """
     - Create song and artist DFs from all the song data
-    - Create CSV files so we can use COPY for better performance
-    - Use COPY to populate the song and artist tables (using query from sql_queries.py)
-    """
-    # Create song DF from ALL song files
-    song_df = df[['song_id', 'title', 'artist_id', 'year', 'duration']]
-    # Sort by song title
-    song_df = song_df.sort_values('title')
-
-    # Create artist DF from ALL song files
-    artist_df = df[['artist_id', 'artist_name', 'artist_location', 'artist_latitude', 'artist_longitude']]
-    # Sort by artist_name
-    artist_df = artist_df.sort_values('artist_name')
-    
-    # Create CSVs so we can use COPY for better data loading performance    
-    song_df.to_csv((csvpath+'/song_df.csv'), index=False)
-    artist_df.to_csv((csvpath+'/artist_df.csv'), index=False)
-    
-    # Insert song data using COPY                            
-    copy_path = datapath+'/csv_files/song_df.csv'
-    cur.execute(song_table_insert, (copy_path,))
-    conn.commit()
+    - Use COPY FROM STDIN to populate the song and artist tables (using query from sql_queries.py)
+    """
+    song_df, artist_df = transform_song_data(df)
+
+    # Insert song data using COPY FROM STDIN
+    copy_df_to_table(cur, conn, song_df, "songs", song_table_insert)
+
+    # Insert artist data using COPY FROM STDIN
+    copy_df_to_table(cur, conn, artist_df, "artists", artist_table_insert)
+
+
+def build_song_index(cur):
+    """
+    Load the songs/artists dimension once into a dict keyed on (title, artist name, duration),
+    with (song_id, artist_id) as the values
+    """
+    with metrics.stage("song index") as record:
+        cur.execute(song_index_select)
+        song_index = {}
+        for title, name, duration, songid, artistid in cur.fetchall():
+            # duration comes back as a Decimal, the log data length is a float
+            song_index.setdefault((title, name, float(duration)), (songid, artistid))
+        record['rows_out'] = len(song_index)
+    return song_index
 
-    # Insert artist data using COPY
-    copy_path = datapath+'/csv_files/artist_df.csv'
-    cur.execute(artist_table_insert, (copy_path,))
+def next_songplay_id(cur, tablename, first_id):
+    """Get the next free songplay_id in tablename (first_id when the table is empty)"""
+    cur.execute(sql.SQL(songplay_max_id_select).format(sql.Identifier(tablename)))
+    max_id = cur.fetchone()[0]
+    return first_id if max_id is None else max_id + 1
+
+def create_partitions(cur, conn, tablename, start_times):
+    """
+    If tablename is partitioned by month on start_time (create_tables.py --partitioned), create the
+    monthly partitions needed for start_times. New partitions get the indexes of the parent table
+    """
+    cur.execute(partitioned_select, (tablename,))
+    if not cur.fetchone()[0]:
+        return
+    for month in start_times.dt.to_period('M').unique():
+        partition = '{}_y{}m{:02d}'.format(tablename, month.year, month.month)
+        cur.execute(sql.SQL(partition_create).format(sql.Identifier(partition), sql.Identifier(tablename), \
+                    sql.Literal(month.start_time.strftime('%Y-%m-%d')), \
+                    sql.Literal((month + 1).start_time.strftime('%Y-%m-%d'))))
     conn.commit()
-        
-def insert_log_data(cur, conn, df, csvpath):
-    """
-    - Create DF of all log files filtered by NextSong
-    - Create time and user DFs and CSV files
-    - Use COPY to populate the time and user tables (using queries from sql_queries.py)
-    - Loop through each row of the log files to create the songplays table
-    """
-    # filter by NextSong action
-    df = df[df['page'].str.contains("NextSong")]
-    # convert timestamp column to datetime
-    t = pd.to_datetime(df.ts, unit='ms') 
-    df['ts'] = t
-    # Sort by start_time
-    df = df.sort_values('ts')
-    
-    # Create time DF from ALL log files
-    time_data = list(zip(t, t.dt.hour, t.dt.day, t.dt.week, t.dt.month, t.dt.year, t.dt.weekday))
-    column_labels = ("start_time", "hour", "day", "week", "month", "year", "weekday")
-    time_df = pd.DataFrame(time_data, columns = column_labels, dtype = int)
-    # Sort by start_time
-    time_df = time_df.sort_values('start_time')
-
-    # Create user DF from ALL log files
-    user_df = df[['userId', 'firstName', 'lastName', 'gender', 'level']]
-    user_df = user_df.astype({"userId": int})
-    
-    # Create CSVs so we can use COPY for better data loading performance
-    time_df.to_csv((csvpath+'/time_df.csv'), index=False)
-    user_df.to_csv((csvpath+'/user_df.csv'), index=False)
-
-    # Insert time data using COPY                            
-    copy_path = datapath+'/csv_files/time_df.csv'
-    cur.execute(time_table_insert, (copy_path,))
-    conn.commit() 
-
-    # Insert user data - loop through all rows instead, based on reviewer comment                     
-    for idx, row in enumerate(user_df.itertuples(index=False)):
-        user_data = (row.userId, row.firstName, row.lastName, row.gender, row.level)        
-        cur.execute(user_table_insert, user_data)
-        conn.commit() 
-        
-    # INSERT SONGPLAY DATA: Loop through each row of the log files
-    # NOTE: use enumerate as a loop counter for songplay_id
-    # Index is False so we get the row number, not the df index
-    for idx, row in enumerate(df.itertuples(index=False), start=1):
 
-        # get songid and artistid from song and artist tables
-        cur.execute(song_select, (row.song, row.artist, row.length))
-        results = cur.fetchone()
+def drop_partitions_before(cur, conn, tablename, cutoff):
+    """
+    Retention: drop the monthly partitions of tablename that only hold songplays before cutoff.
+    Only the dropped partitions are touched, the other months are not scanned
+    """
+    cutoff = pd.Timestamp(cutoff)
+    cur.execute(partition_select, (tablename,))
+    for (partition,) in cur.fetchall():
+        # partition names end with _yYYYYmMM (see create_partitions)
+        month = pd.Period(partition[-7:].replace('m', '-'), freq='M')
+        if (month + 1).start_time <= cutoff:
+            cur.execute(sql.SQL('DROP TABLE {}').format(sql.Identifier(partition)))
+            print('Dropped partition {}'.format(partition))
+    conn.commit()
 
-        if results:
-            songid, artistid = results
-        else:
-            songid, artistid = None, None
+def transform_log_data(cur, conn, df):
+    """
+    One pass over a batch of log data, shared by all the log tables:
+    - Filter to the NextSong events, convert ts to datetime and sort by start_time ONCE
+    (stable sort, so events with the same ts keep their file order)
+    - Number the events with songplay ids, the same ids in songplays and songplays_fill
+    - Create the time DF (one row per start_time) and the user DF (latest row per user)
+    - Return the events, time and user DFs
+    """
+    with metrics.stage("transform log_data", rows_in=len(df)) as record:
+        # filter by NextSong action (exact match)
+        df = df[df['page'] == "NextSong"]
+        # convert timestamp column to datetime, and sort by start_time
+        df['ts'] = pd.to_datetime(df['ts'], unit='ms')
+        df = df.sort_values('ts', kind='stable')
 
-        # insert songplay record
-        songplay_data = (row.ts, row.userId, row.level, songid, artistid, \
-                                     row.sessionId, row.location, row.userAgent)   
-        cur.execute(songplay_table_insert, songplay_data)    
+        # Insert songplay_id column: number the events in start_time order, after the highest id
+        # of both songplays tables (from 1 on empty tables)
+        first_id = max(next_songplay_id(cur, "songplays", first_id=1), \
+                       next_songplay_id(cur, "songplays_fill", first_id=1))
+        # end the read transaction, so the loads on the other connections can lock the songplays tables
+        # (to create partitions, or build the keys in bulk load mode)
         conn.commit()
-        
-def fill_songplay_data(cur, conn, df, csvpath):
+        df.insert(0, 'songplay_id', range(first_id, first_id + len(df)))
+
+        # Create time DF from ALL log files (df is sorted, so time_df is sorted by start_time)
+        t = df['ts']
+        time_df = pd.DataFrame({"start_time": t, "hour": t.dt.hour, "day": t.dt.day, \
+                                "week": t.dt.isocalendar().week, "month": t.dt.month, "year": t.dt.year, \
+                                "weekday": t.dt.weekday})
+        time_df = time_df.drop_duplicates('start_time')
+
+        # Create user DF from ALL log files
+        # Keep only the most recent row per userId (df is sorted by ts), so the latest level wins
+        user_df = df[['userId', 'firstName', 'lastName', 'gender', 'level']]
+        user_df = user_df.drop_duplicates('userId', keep='last')
+        record['rows_out'] = len(df)
+    return df, time_df, user_df
+
+def load_songplay_data(cur, conn, df, song_index=None):
+    """
+    - Match each NextSong event of the transformed log DF against the song index
+    and COPY the songplays table in one batch (the songs and artists must be loaded first)
+    - The song index is built here unless it is given (streaming mode builds it once for all the chunks)
+    - Return the songplays DF
     """
-    Create a filled songplay table in Postgres with complete artist and song information.
-    Use artist_name and song_name from the log data instead of song_id and artist_id.
+    if song_index is None:
+        song_index = build_song_index(cur)
+    # INSERT SONGPLAY DATA: get songid and artistid for each event from the in-memory song index
+    # (one dictionary probe per event instead of a song_select round trip)
+    with metrics.stage("match songplays", rows_in=len(df)) as record:
+        matches = [song_index.get(key, (None, None)) for key in zip(df.song, df.artist, df.length)]
+        songplay_df = df[['songplay_id', 'ts', 'userId', 'level', 'song', 'artist', 'sessionId', 'location', \
+                          'userAgent']]
+        songplay_df['song'] = [songid for songid, artistid in matches]
+        songplay_df['artist'] = [artistid for songid, artistid in matches]
+        record['rows_out'] = int(songplay_df['song'].notna().sum()) # number of matched events
+    # Insert songplay data using COPY FROM STDIN
+    create_partitions(cur, conn, "songplays", songplay_df['ts'])
+    copy_df_to_table(cur, conn, songplay_df, "songplays", songplay_table_insert)
+    return songplay_df
+
+def fill_songplay_data(cur, conn, df):
+    """
+    Create a filled songplay table in Postgres with complete artist and song information, from the
+    transformed log DF. Use artist_name and song_name from the log data instead of song_id and artist_id.
     """
-    df = df[df['page'].str.contains("NextSong")] # Filter to only NextSong actions
-    t = pd.to_datetime(df.ts, unit='ms') # convert ts column to datetime
-    df['ts'] = t
-    # Sort by start_time
-    df = df.sort_values('ts')   
     # Select columns (using artist NAME and song NAME instead of ids)
-    songplay_df = df[['ts', 'userId', 'level', 'song', 'artist', 'sessionId', 'location', 'userAgent']]
-    # Insert songplay_id column (each row is a different songplay_id)
-    songplay_df['songplay_id'] = songplay_df.reset_index().index
-    songplay_df = songplay_df[['songplay_id', 'ts', 'userId', 'level', 'song', 'artist', 'sessionId', 'location', \
-                               'userAgent']]
-    # Create CSV so we can use COPY for better data loading performance
-    songplay_df.to_csv(csvpath+'/songplay_df.csv', index=False)
-    # Insert data using COPY                            
-    copy_path = datapath+'/csv_files/songplay_df.csv'
-    cur.execute(songplay_table_insert_2, (copy_path,))
-    conn.commit() 
+    songplay_df = df[['songplay_id', 'ts', 'userId', 'level', 'song', 'artist', 'sessionId', 'location', \
+                      'userAgent']]
+    # Insert data using COPY FROM STDIN
+    create_partitions(cur, conn, "songplays_fill", songplay_df['ts'])
+    copy_df_to_table(cur, conn, songplay_df, "songplays_fill", songplay_table_insert_2)
     return songplay_df
+
+def log_table_loads(events_df, time_df, user_df, depends_on=(), song_index=None):
+    """
+    Table loads for a batch of transformed log data (see transform_log_data and load_tables):
+    time, users, songplays and songplays_fill.
+    depends_on names the loads the songplays match must wait for (the songs and artists of the same run),
+    song_index is the song index to match against (built by the songplays load if None)
+    """
+    return [("time", copy_df_to_table, (time_df, "time", time_table_insert), ()),
+            ("users", copy_df_to_table, (user_df, "users", user_table_insert), ()),
+            ("songplays", load_songplay_data, (events_df, song_index), tuple(depends_on)),
+            ("songplays_fill", fill_songplay_data, (events_df,), ())]
+
+def run_loads(cur, conn, loads):
+    """Run the table loads (see load_tables) one after another on one connection, in list order"""
+    return {name: func(cur, conn, *args) for name, func, args, depends_on in loads}
+
+def insert_log_data(cur, conn, df):
+    """
+    - Transform the log data in one pass (see transform_log_data)
+    - Use COPY FROM STDIN to populate the time and user tables (using queries from sql_queries.py)
+    - Match each NextSong event against the song index and COPY the songplays table in one batch
+    - COPY the same events into the songplays_fill table
+    - Return the time, user, songplays and songplays_fill DFs
+    """
+    events_df, time_df, user_df = transform_log_data(cur, conn, df)
+    results = run_loads(cur, conn, log_table_loads(events_df, time_df, user_df))
+    return time_df, user_df, results["songplays"], results["songplays_fill"]
+
+def create_pool(dsn, workers=load_workers):
+    """Bounded pool of (at most workers) connections to dsn for the concurrent table loads"""
+    return psycopg2.pool.ThreadedConnectionPool(1, workers, dsn, connection_factory=metrics.MetricsConnection)
+
+def run_load(pool, futures, func, args, depends_on):
+    """
+    Run one table load on a connection from the pool, once the loads it depends on are done.
+    The load commits its own transaction, on error it is rolled back so the table is left as it was
+    """
+    for name in depends_on:
+        futures[name].result() # re-raises the error of a failed dependency
+    conn = pool.getconn()
+    try:
+        return func(conn.cursor(), conn, *args)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn)
+
+def load_tables(pool, loads):
+    """
+    - Run the table loads concurrently on a pool of threads, each load on its own pooled connection,
+    so the load wall time is close to the slowest table instead of the sum of all tables
+    (one thread per pooled connection, so the pool is never exhausted)
+    - loads is a list of (name, func, args, depends_on), where func(cur, conn, *args) loads one table
+    in one transaction, and depends_on names loads listed before it that must finish first
+    - Wait for all the loads, then return a dict of the load names to their return values
+    (or raise the first error, the loads that succeeded stay committed)
+    """
+    futures = {}
+    with metrics.stage("load tables", rows_in=len(loads)) as record:
+        # the loads are started in list order, so a load only ever waits on loads that are already running
+        with ThreadPoolExecutor(max_workers=pool.maxconn) as executor:
+            for name, func, args, depends_on in loads:
+                futures[name] = executor.submit(run_load, pool, futures, func, args, depends_on)
+        results = {name: future.result() for name, future in futures.items()}
+        record['rows_out'] = len(results)
+    return results
         
-def quality_check_data(cur, conn, df, idcol, tablename, reset_query):
+def song_quality_checks(df):
+    """Expected keys of the songs and artists tables for a batch of song data"""
+    song_ids = df['song_id'].dropna().unique().tolist()
+    artist_ids = df['artist_id'].dropna().unique().tolist()
+    return [{'table': 'songs', 'keys_query': song_check_keys, 'params': {'song_ids': song_ids}, \
+             'keys': set(song_ids), 'checksum': None},
+            {'table': 'artists', 'keys_query': artist_check_keys, 'params': {'artist_ids': artist_ids}, \
+             'keys': set(artist_ids), 'checksum': None}]
+
+def songplay_event_keys(df):
+    """Natural keys of the songplays DF, as the start_time (epoch ms)/user_id/session_id text of songplay_check_keys"""
+    return set(((df['ts'].astype('int64') // 10**6).astype(str) + '/' + \
+                df['userId'].to_numpy(dtype='int64').astype(str) + '/' + df['sessionId'].astype(str)).tolist())
+
+def late_event_params(time_df, songplay_df, watermark):
     """
-    Check if the number of table rows in Postgres equals the number of unique ids 
-    from the json data.
-    If check fails: reset the table in Postgres
+    Keys of the batch events at or before the watermark (late events, e.g. from a file delivered late
+    or a changed file), as arrays for the by-key part of the time and songplays checks
     """
-    table_rows = cur.execute(sql.SQL('SELECT COUNT(*) FROM {}').format(sql.Identifier(tablename)))
-    table_rows = cur.fetchone()
-    print('{} total rows in {} table in PostGres.'.format(table_rows[0], tablename))
-    if tablename == "songplays":
-        num_ids = len(df) # each row is a different songplay_id in the songplays table
-    else:
-        num_ids = len(df[idcol].unique())
-    print('{} total unique {}s from the json files'.format(num_ids, idcol))
-    if table_rows[0] != num_ids:
-        cur.execute(sql.SQL('DROP TABLE IF EXISTS {}').format(sql.Identifier(tablename)))
-        cur.execute(reset_query)
-        conn.commit()
-        raise ValueError("{} table: Table length and unique ids do not match. Resetting table in PostGres" \
-        .format(tablename))
+    if watermark is None:
+        late_times, late_events = time_df['start_time'].iloc[:0], songplay_df.iloc[:0]
     else:
-        print("Check passed!")
+        late_times = time_df['start_time'][time_df['start_time'] <= watermark]
+        late_events = songplay_df[songplay_df['ts'] <= watermark]
+    # one entry per natural key, so a key repeated in the batch is not counted twice by the join
+    late_events = late_events.drop_duplicates(['ts', 'userId', 'sessionId'])
+    return {'time_after': None if watermark is None else watermark.to_pydatetime(), \
+            'late_times': late_times.dt.to_pydatetime().tolist(), \
+            'late_start_times': late_events['ts'].dt.to_pydatetime().tolist(), \
+            'late_user_ids': late_events['userId'].to_numpy(dtype='int64').tolist(), \
+            'late_session_ids': late_events['sessionId'].to_numpy(dtype='int64').tolist()}
+
+def log_quality_checks(time_df, user_df, songplay_df, fill_df, watermark=None):
+    """
+    Expected keys of the time, users, songplays and songplays_fill tables for a batch of log data.
+    The DFs are the rows that were loaded from the batch (see transform_log_data), so the log events
+    are not filtered again.
+    The songplays tables must hold exactly one row per natural key of the batch, so the check fails
+    on events loaded twice as well as on missing ones:
+    - After the watermark of the earlier runs (see read_watermark), only this batch loaded events,
+    so the whole start_time range of the batch is checked
+    - Late events at or before the watermark share their range with earlier loads, so they are checked by key
+    """
+    if len(time_df) == 0:
+        return []
+    # time keys as epoch ms, like the ts column in the json
+    start_times = set((time_df['start_time'].astype('int64') // 10**6).tolist())
+    # start_time range of the batch after the watermark, and keys of the late events, for the time
+    # and songplays checks
+    time_range = {'time_first': time_df['start_time'].min().to_pydatetime(), \
+                  'time_last': time_df['start_time'].max().to_pydatetime()}
+    time_range.update(late_event_params(time_df, songplay_df, watermark))
+    # the users must hold the latest level of the batch
+    user_ids = user_df['userId'].to_numpy(dtype='int64').tolist() # plain ints for psycopg2
+    return [{'table': 'time', 'keys_query': time_check_keys, 'keys': start_times, 'checksum': 'sum', \
+             'params': time_range},
+            {'table': 'users', 'keys_query': user_check_keys, 'keys': set(user_ids), 'checksum': None, \
+             'params': {'user_ids': user_ids, 'levels': user_df['level'].tolist()}},
+            {'table': 'songplays', 'keys_query': songplay_check_keys, 'keys': songplay_event_keys(songplay_df), \
+             'checksum': 'md5', 'params': time_range},
+            {'table': 'songplays_fill', 'keys_query': songplay_check_keys_2, 'keys': songplay_event_keys(fill_df), \
+             'checksum': 'md5', 'params': time_range}]
+
+def key_checksum(keys, checksum):
+    """Checksum of the expected keys of a check, computed like check_sum or check_md5_sum in Postgres"""
+    if checksum == 'md5':
+        return sum(int(hashlib.md5(key.encode()).hexdigest()[:15], 16) for key in keys)
+    return sum(keys)
+
+def quality_check_data(cur, checks):
+    """
+    Check that Postgres holds exactly the keys of the batch just loaded, for every table in checks.
+    - The expected keys (and key checksums) come from the in-memory batch (see song_quality_checks
+    and log_quality_checks), and all the checks of a batch are sent in ONE query
+    - Tables checked by key range (time, songplays) also compare a checksum of the keys (see key_checksum),
+    so a missing key can't be hidden by an unexpected one
+    - If a check fails: raise a ValueError with the offending keys. The tables are NOT reset
+    """
+    if not checks:
+        return
+    with metrics.stage("quality check", rows_in=sum(len(check['keys']) for check in checks)) as record:
+        query = sql.SQL(" UNION ALL ").join(
+            sql.SQL(check_select).format(sql.Literal(check['table']), \
+                                         sql.SQL({'sum': check_sum, 'md5': check_md5_sum} \
+                                                 .get(check['checksum'], "NULL::numeric")), \
+                                         sql.SQL(check['keys_query'])) for check in checks)
+        params = {}
+        for check in checks:
+            params.update(check['params'])
+        cur.execute(query, params)
+        results = {tablename: (num_rows, checksum) for tablename, num_rows, checksum in cur.fetchall()}
+
+        failed = []
+        for check in checks:
+            num_rows, checksum = results[check['table']]
+            print('{} rows in {} table in PostGres for the {} unique keys of this batch' \
+                  .format(num_rows, check['table'], len(check['keys'])))
+            if num_rows != len(check['keys']) or \
+               (check['checksum'] and checksum != key_checksum(check['keys'], check['checksum'])):
+                failed.append(check)
+        record['rows_out'] = sum(num_rows for num_rows, checksum in results.values())
+
+    if failed:
+        # Only on failure: fetch the keys of each failed table to report the offending ones
+        messages = []
+        for check in failed:
+            cur.execute(check['keys_query'], check['params'])
+            counts = collections.Counter(row[0] for row in cur.fetchall())
+            missing = sorted(check['keys'] - counts.keys())
+            unexpected = sorted(counts.keys() - check['keys'])
+            duplicates = sorted(key for key, count in counts.items() if count > 1)
+            messages.append("{} table: {} missing keys {}, {} unexpected keys {}, {} duplicate keys {}".format( \
+                            check['table'], len(missing), missing[:10], len(unexpected), unexpected[:10], \
+                            len(duplicates), duplicates[:10]))
+        raise ValueError("Quality check failed (tables were not reset):\n" + "\n".join(messages))
+    print("Check passed!")
         
-def process_data(cur, conn, filepath, func):
+def refresh_rollups(cur, conn):
+    """
+    Post-load stage: add the plays loaded since the last refresh to the rollup tables used by the dashboard
+    (analytics.py).
+    - The last songplay_id rolled up from each songplays table is kept in etl_watermark, and moved
+    in the same transaction as the rollup upserts, so each play is counted once
+    - Plays left out by a refresh that failed (or never ran) are added by the next one
+    """
+    with metrics.stage("rollup") as record:
+        # lock the rollup watermarks, and read the ids loaded since the last refresh
+        cur.execute(rollup_watermark_select)
+        rolled_up = dict(cur.fetchall())
+        params = {}
+        for tablename, prefix in (("songplays", "songplay"), ("songplays_fill", "fill")):
+            params[prefix + '_from'] = rolled_up.get('rollup_' + tablename, 0) # songplay ids start at 1
+            params[prefix + '_to'] = max(params[prefix + '_from'], next_songplay_id(cur, tablename, first_id=1) - 1)
+        record['rows_in'] = params['songplay_to'] - params['songplay_from'] + params['fill_to'] - params['fill_from']
+        record['rows_out'] = 0
+        if record['rows_in'] > 0:
+            for query in rollup_refresh_queries:
+                cur.execute(query, params)
+                record['rows_out'] += cur.rowcount
+            for tablename, prefix in (("songplays", "songplay"), ("songplays_fill", "fill")):
+                cur.execute(rollup_watermark_insert, ('rollup_' + tablename, params[prefix + '_to']))
+        conn.commit()
+
+def file_hash(filepath):
+    """Get the sha256 hex digest of the file contents"""
+    h = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def find_new_files(cur, filepath, incremental):
+    """
+    - get list of all json files in the directory, with their size, mtime and content hash
+    - In incremental mode, keep only the files that are new or changed since they were recorded
+    in the etl_manifest table (files with the same size and mtime are not even hashed)
+    - Return the files to process, and a manifest DF to record once they are loaded
+    """
+    loaded = {}
+    if incremental:
+        cur.execute(manifest_select)
+        loaded = {row[0]: row[1:] for row in cur.fetchall()}
+
+    all_files = discover_files(filepath)
+    new_files, manifest_rows = [], []
+    with metrics.stage("fingerprint", rows_in=len(all_files)) as record:
+        for datafile in all_files:
+            stat = os.stat(datafile)
+            previous = loaded.get(datafile)
+            if previous and previous[0] == stat.st_size and previous[1] == stat.st_mtime:
+                continue
+            content_hash = file_hash(datafile)
+            # a file that was only touched is recorded again, but not parsed again
+            if not (previous and previous[2] == content_hash):
+                new_files.append(datafile)
+            manifest_rows.append((datafile, stat.st_size, stat.st_mtime, content_hash))
+        record['rows_out'] = len(new_files)
+
+    if incremental:
+        print('{} new or changed files in {}'.format(len(new_files), filepath))
+    manifest_df = pd.DataFrame(manifest_rows, columns=['filepath', 'size', 'mtime', 'content_hash'])
+    manifest_df['loaded_at'] = pd.Timestamp.now()
+    return new_files, manifest_df
+
+def record_manifest(cur, conn, manifest_df):
+    """Record the loaded files in the etl_manifest table, using COPY FROM STDIN"""
+    copy_df_to_table(cur, conn, manifest_df, "etl_manifest", manifest_insert)
+
+def read_watermark(cur):
+    """
+    Get the songplays watermark, the latest start_time loaded by the earlier runs (None before the first load).
+    The log events are never filtered on it: late events are loaded like the others, and the events
+    loaded before are skipped on their natural key. It tells the quality checks which events
+    may share their start_time range with earlier loads (see log_quality_checks)
+    """
+    cur.execute(watermark_select)
+    result = cur.fetchone()
+    return None if result is None or result[0] is None else pd.Timestamp(result[0])
+
+def update_watermark(cur, conn, time_df):
+    """Move the songplays watermark to the latest start_time loaded (time_df of the batch)"""
+    if len(time_df) > 0:
+        cur.execute(watermark_insert, (time_df['start_time'].max().to_pydatetime(),))
+        conn.commit()
+
+def process_data(cur, conn, filepath, func, workers=num_workers, all_files=None, cache=None):
     """
-    - get list of all json files in the directory
-    - Iterate and append each json file into the same pandas DF
+    - get list of all json files in the directory (unless all_files is given)
+    - Parse the json files in parallel on a pool of worker processes (or read them from the parse cache)
+    - Concatenate all the parsed files into one pandas DF at the end
     """
     # get all files matching extension from directory
-    all_files = []
-    for root, dirs, files in os.walk(filepath):
-        files = glob.glob(os.path.join(root,'*.json'))
-        for f in files :
-            all_files.append(os.path.abspath(f))
+    if all_files is None:
+        all_files = discover_files(filepath)
 
     # get total number of files found
     num_files = len(all_files)
     print('{} files found in {}'.format(num_files, filepath))
+    if num_files == 0:
+        return pd.DataFrame()
 
     # iterate over files and process
-    df = pd.DataFrame()
-    for i, datafile in enumerate(all_files, 1):
-        df_temp = func(cur, datafile)
-        df = df.append(df_temp)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            df = parse_files(all_files, func, executor, workers, cache)
+    else:
+        df = parse_files(all_files, func, cache=cache)
         
-    print('{}/{} total files processed.'.format(i, num_files))
+    print('{}/{} total files processed.'.format(num_files, num_files))
     # Return complete df with data from all files    
     return df
 
+def parse_batches(all_files, func, executor=None, workers=1):
+    """
+    Parse the files in batches with func (see json_files.process_json_files), on the executor worker
+    processes if given, and concatenate the DFs of the batches once into one typed DF.
+    Return the DF and the rows of each file
+    """
+    # hand the files to the workers in batches, so tiny files don't pay one round trip each
+    # (and each worker sends back one DF per batch, not one per file)
+    size = max(1, len(all_files) // (workers * 4)) if executor is not None else max(1, len(all_files))
+    batches = [all_files[start:start + size] for start in range(0, len(all_files), size)]
+    parsed = list(executor.map(func, batches) if executor is not None else map(func, batches))
+    return concat_frames([frame for frame, file_rows in parsed]), \
+           [num_rows for frame, file_rows in parsed for num_rows in file_rows]
+
+def parse_files(all_files, func, executor=None, workers=1, cache=None):
+    """
+    Get the files as one typed DF: parse them in batches (see parse_batches), or with a parse cache
+    (see parse_cache.py), read the unchanged files from the cache and only parse the others
+    """
+    with metrics.stage("parse", rows_in=len(all_files)) as record:
+        if cache is None:
+            df = parse_batches(all_files, func, executor, workers)[0]
+        else:
+            df = cache.load(all_files, lambda files: parse_batches(files, func, executor, workers))
+        record['rows_out'] = len(df)
+    return df
+
+def plan_log_chunks(all_files, chunk_files=0, chunk_mb=0):
+    """
+    Split the log files into consecutive chunks of at most chunk_files files and chunk_mb MB of json
+    (0 for no limit), so a chunk is sized by the data it holds and not only by its number of days.
+    A file bigger than chunk_mb makes a chunk on its own
+    """
+    chunks, chunk, chunk_bytes = [], [], 0
+    for datafile in all_files:
+        size = os.path.getsize(datafile)
+        if chunk and ((chunk_files and len(chunk) >= chunk_files) or \
+                      (chunk_mb and chunk_bytes + size > chunk_mb * 1024**2)):
+            chunks.append(chunk)
+            chunk, chunk_bytes = [], 0
+        chunk.append(datafile)
+        chunk_bytes += size
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+def plan_song_chunks(all_files, chunk_mb=0):
+    """
+    Split the song files into consecutive chunks of at most chunk_mb MB of json (see plan_log_chunks),
+    or of song_chunk_files files without chunk_mb: --chunk-files counts log files (days), not songs
+    """
+    return plan_log_chunks(all_files, 0 if chunk_mb else song_chunk_files, chunk_mb)
+
+def check_memory(max_memory_mb):
+    """
+    Raise a MemoryError if the process is over max_memory_mb of resident memory right now
+    (where the current memory can't be read, the peak memory of the process is used instead)
+    """
+    if max_memory_mb is None:
+        return
+    memory = metrics.current_memory_mb()
+    if memory is None:
+        memory = metrics.peak_memory_mb()
+    if memory is not None and memory > max_memory_mb:
+        raise MemoryError("Memory {:.0f} MB is over the {} MB limit, use a smaller --chunk-mb or --prefetch" \
+                          .format(memory, max_memory_mb))
+
+def read_log_chunks(chunks, func, workers=num_workers, max_memory_mb=None, cache=None):
+    """
+    Generator: parse the log files one chunk (list of files, see plan_log_chunks) at a time
+    and yield (chunk files, DF) pairs.
+    The log files are sorted by name (one file per day), so the chunks come in event time order.
+    The memory is checked before each chunk is parsed, so a run over max_memory_mb stops
+    before it takes in more data
+    """
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        for chunk in chunks:
+            check_memory(max_memory_mb)
+            yield chunk, parse_files(chunk, func, executor, workers, cache)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+def prefetch_chunks(chunks, depth=prefetch_depth):
+    """
+    Run the chunks generator (e.g. read_log_chunks) in a background thread, so the next chunks are parsed
+    while the current one is loaded into Postgres.
+    - The parsed chunks wait in a queue of depth chunks. When it is full the thread blocks (backpressure),
+    so at most depth + 2 chunks are in memory: queued, being parsed and being loaded
+    - The thread starts right away, so parsing also overlaps whatever runs before the first chunk is taken
+    - An error in the thread is raised again in the consumer. Closing the consumer stops the thread
+    """
+    buffer = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # wait for room in the queue, unless the consumer has stopped
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for chunk in chunks:
+                if not put(chunk):
+                    break
+            else:
+                put(done)
+        except Exception as error:
+            put((None, error))
+        finally:
+            chunks.close() # shuts down the parser processes of read_log_chunks
+
+    def consume():
+        try:
+            while True:
+                item = buffer.get()
+                if item is done:
+                    return
+                if item[0] is None:
+                    raise item[1]
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+    thread = threading.Thread(target=produce, name="prefetch_chunks", daemon=True)
+    thread.start()
+    return consume()
+
+def filter_log_chunks(chunks):
+    """Generator: keep only the NextSong events of each chunk, so the later stages never hold the other log events"""
+    for chunk, df in chunks:
+        # rebind df, so this generator doesn't keep the whole chunk alive while it is loaded
+        df = df[df['page'] == "NextSong"]
+        yield chunk, df
+
+def load_log_chunks(chunks, cur, conn, manifest_df, pool=None, song_index=None, max_memory_mb=None):
+    """
+    - Load each chunk into the time, users, songplays and songplays_fill tables (concurrently
+    if a connection pool is given), quality check it and add it to the rollup tables.
+    The songplays of every chunk are matched against the same song_index (built once if None)
+    - Move the watermark and record the chunk files in the manifest after each chunk,
+    so an interrupted backfill picks up where it stopped on the next incremental run
+    - The memory is checked again before each chunk is transformed and loaded (see check_memory)
+    """
+    if song_index is None:
+        song_index = build_song_index(cur)
+    for chunk, df in chunks:
+        if len(df) > 0:
+            watermark = read_watermark(cur)
+            check_memory(max_memory_mb)
+            events_df, time_df, user_df = transform_log_data(cur, conn, df)
+            check_memory(max_memory_mb)
+            loads = log_table_loads(events_df, time_df, user_df, song_index=song_index)
+            results = load_tables(pool, loads) if pool is not None else run_loads(cur, conn, loads)
+            songplay_df, fill_df = results["songplays"], results["songplays_fill"]
+            quality_check_data(cur, log_quality_checks(time_df, user_df, songplay_df, fill_df, watermark))
+            refresh_rollups(cur, conn)
+            update_watermark(cur, conn, time_df)
+        record_manifest(cur, conn, manifest_df[manifest_df['filepath'].isin(chunk)])
+        print('{} log events loaded from {} files'.format(len(df), len(chunk)))
+        yield chunk
+
+def read_log_pipeline(all_files, func, chunk_files=0, workers=num_workers, prefetch=prefetch_depth, chunk_mb=0, \
+                      max_memory_mb=None, cache=None, song_chunks=()):
+    """
+    Start reading the log files in chunks of at most chunk_files files and chunk_mb MB (see plan_log_chunks
+    and read_log_chunks), parsed in the background up to prefetch chunks ahead of the loads
+    (see prefetch_chunks, 0 to parse inline). No chunk is parsed while the process is over max_memory_mb.
+    The song_chunks (see plan_song_chunks) are read first through the same parser processes and queue:
+    the first len(song_chunks) chunks yielded are song data (see stream_song_data), so the first log chunks
+    are parsed while the last song chunks load
+    """
+    plan = plan_log_chunks(all_files, chunk_files, chunk_mb)
+    if song_chunks:
+        print('{} song files found, streaming them in {} chunks'.format(sum(map(len, song_chunks)), \
+                                                                       len(song_chunks)))
+    print('{} log files found, streaming them in {} chunks'.format(len(all_files), len(plan)))
+    chunks = read_log_chunks(list(song_chunks) + plan, func, workers, max_memory_mb, cache)
+    if prefetch > 0:
+        chunks = prefetch_chunks(chunks, prefetch)
+    return chunks
+
+def stream_song_data(cur, conn, all_files, manifest_df, chunks, pool=None, max_memory_mb=None):
+    """
+    Load the song data chunks (the first chunks of read_log_pipeline) one at a time into the songs and artists
+    tables (concurrently if a connection pool is given), quality check each chunk and record its files
+    in the manifest, so the song data is never held in memory all at once.
+    The memory is checked again before each chunk is transformed and loaded (see check_memory)
+    """
+    # manifest rows for files that were only touched are not part of any chunk
+    record_manifest(cur, conn, manifest_df[~manifest_df['filepath'].isin(all_files)])
+    num_files = 0
+    for chunk, df in chunks:
+        if len(df) > 0:
+            check_memory(max_memory_mb)
+            loads = song_table_loads(*transform_song_data(df))
+            if pool is not None:
+                load_tables(pool, loads)
+            else:
+                run_loads(cur, conn, loads)
+            quality_check_data(cur, song_quality_checks(df))
+        record_manifest(cur, conn, manifest_df[manifest_df['filepath'].isin(chunk)])
+        num_files += len(chunk)
+    print('{}/{} total song files processed.'.format(num_files, len(all_files)))
+
+def stream_log_data(cur, conn, all_files, manifest_df, chunks, pool=None, song_index=None, max_memory_mb=None):
+    """
+    Process the log data chunks (see read_log_pipeline) through a generator pipeline
+    (read -> filter -> load), so only a few chunks are held in memory at a time.
+    The songs and artists must be loaded first, song_index is built once from them if None
+    """
+    # manifest rows for files that were only touched are not part of any chunk
+    record_manifest(cur, conn, manifest_df[~manifest_df['filepath'].isin(all_files)])
+    chunks = filter_log_chunks(chunks)
+    num_files = 0
+    for chunk in load_log_chunks(chunks, cur, conn, manifest_df, pool, song_index, max_memory_mb):
+        num_files += len(chunk)
+    print('{}/{} total files processed.'.format(num_files, len(all_files)))
+
+def parse_args():
+    """Command line options for the ETL run (defaults are set at the top of this file)"""
+    parser = argparse.ArgumentParser(description="Load the Sparkify json data into Postgres")
+    parser.add_argument('--workers', type=int, default=num_workers,
+                        help="number of processes used to parse the json files (default: {})".format(num_workers))
+    parser.add_argument('--load-workers', type=int, default=load_workers,
+                        help="number of tables loaded concurrently on pooled connections (default: {})" \
+                             .format(load_workers))
+    parser.add_argument('--parse-cache', default=parse_cache.default_cache_dir, metavar='DIR',
+                        help="cache the parsed, typed json data in DIR as Arrow files (default: {})" \
+                             .format(parse_cache.default_cache_dir))
+    parser.add_argument('--no-parse-cache', action='store_true',
+                        help="always parse the json files, without reading or writing the parse cache")
+    parser.add_argument('--incremental', action='store_true',
+                        help="only load the json files that are new or changed since the last run")
+    parser.add_argument('--chunk-files', type=int, default=0,
+                        help="stream the log data through the pipeline this many files (days) at a time")
+    parser.add_argument('--chunk-mb', type=int, default=0,
+                        help="stream the log data through the pipeline in chunks of at most this many MB of json")
+    parser.add_argument('--prefetch', type=int, default=prefetch_depth,
+                        help="in streaming mode, parse up to this many chunks ahead of the loads (default: {}, " \
+                             "0 to parse and load in turn)".format(prefetch_depth))
+    parser.add_argument('--max-memory-mb', type=int, default=None,
+                        help="in streaming mode, stop before a chunk is parsed, transformed or loaded when " \
+                             "the process memory is over this limit (checked between these steps, not during them)")
+    parser.add_argument('--drop-before', default=None, metavar='DATE',
+                        help="drop the monthly songplays partitions that end on or before DATE (partitioned layout)")
+    parser.add_argument('--metrics', default=None, metavar='FILE',
+                        help="append per-stage metrics to FILE as JSON lines and print a summary table")
+    parser.add_argument('--profile', default='', metavar='STAGES',
+                        help="comma separated stages to run under cProfile (e.g. parse,match)")
+    parser.add_argument('--trace-memory', default='', metavar='STAGES',
+                        help="comma separated stages to run under tracemalloc (e.g. transform,copy)")
+    return parser.parse_args()
+
 def main():
     """Please see the in-line comments for descriptions of what is happening"""
-    conn = psycopg2.connect(dbstring) # dbstring defined at top of sql_queries
+    args = parse_args()
+    # Stage metrics (wall time, rows, bytes sent, round trips, memory), see metrics.py
+    metrics.recorder.configure(output=args.metrics, profile_stages=filter(None, args.profile.split(',')), \
+                               trace_stages=filter(None, args.trace_memory.split(',')))
+    # dbstring defined at top of sql_queries
+    conn = psycopg2.connect(dbstring, connection_factory=metrics.MetricsConnection)
     cur = conn.cursor()
     
-    # Create df of all song data
-    df = process_data(cur, conn, filepath='data/song_data', func=process_json_file)
-    # Create song and artist dfs and csv files, then copy the data into the Postgres tables
-    insert_song_data(cur, conn, df, csvpath='data/csv_files')
-
-    # Quality check song and artist tables: Ensure the number of table rows in Postgres
-    # equals the number of unique song and artist ids from the song data
-    quality_check_data(cur, conn, df, idcol="song_id", tablename="songs", reset_query=song_table_create)
-    quality_check_data(cur, conn, df, idcol="artist_id", tablename="artists", reset_query=artist_table_create)
-    
-    # Create df of all the log data
-    df = process_data(cur, conn, filepath='data/log_data', func=process_json_file)
-    # Create time and user dfs and csv files, then copy into Postgres tables
-    # Then loop through all NextSong events and insert records into the songplay table
-    insert_log_data(cur, conn, df, csvpath='data/csv_files')
-    
-    # Quality check time, user, and songplay tables: Ensure the number of table rows in Postgres
-    # equals the number of unique ids from the log data
-    df = df[df['page'].str.contains("NextSong")] # Filter to only NextSong actions
-    df = df.astype({"userId": int}) # Set userId to all integers
-    quality_check_data(cur, conn, df, idcol="ts", tablename = "time", reset_query=time_table_create)
-    quality_check_data(cur, conn, df, idcol="userId", tablename = "users", reset_query=user_table_create)
-    quality_check_data(cur, conn, df, idcol="songplay_id", tablename = "songplays", reset_query=songplay_table_create)
+    # Bounded pool of connections for the concurrent table loads
+    pool = create_pool(dbstring, args.load_workers)
+
+    # In incremental mode only the new or changed files are parsed and loaded (see the etl_manifest table)
+    streaming = args.chunk_files > 0 or args.chunk_mb > 0
+    # Parsed json files are read back from the parse cache unless they changed (see parse_cache.py)
+    cache = parse_cache.open_cache(None if args.no_parse_cache else args.parse_cache, version=json_schema_version)
     
-    # Create a filled songplay table in Postgres with complete artist and song information
-    # Use artist_name and song_name from the log data instead of the ids from the song data
-    # This is because there is only ONE row in the songplays table with NON NULL song_id and artist ids   
-    songplay_df = fill_songplay_data(cur, conn, df, csvpath='data/csv_files')
-    # Quality check filled songplays table: Ensure the number of table rows in Postgres
-    # equals the number of unique songplay ids from the log data
-    quality_check_data(cur, conn, songplay_df, idcol="songplay_id", tablename = "songplays_fill", \
-                       reset_query=songplay_table_create_2)
+    song_files, song_manifest_df = find_new_files(cur, 'data/song_data', args.incremental)
+    log_files, log_manifest_df = find_new_files(cur, 'data/log_data', args.incremental)
+    if streaming:
+        # Start parsing the song data, then the log data, a chunk at a time in the background:
+        # the song chunks come first through the same parser processes and queue,
+        # so the first log chunks are parsed while the last songs and artists load
+        song_chunks = plan_song_chunks(song_files, args.chunk_mb)
+        chunks = read_log_pipeline(log_files, process_json_files, args.chunk_files, args.workers, args.prefetch, \
+                                   chunk_mb=args.chunk_mb, max_memory_mb=args.max_memory_mb, cache=cache, \
+                                   song_chunks=song_chunks)
+
+        # The songs and artists are loaded (and quality checked) one chunk at a time,
+        # before the log chunks are matched against them
+        stream_song_data(cur, conn, song_files, song_manifest_df, itertools.islice(chunks, len(song_chunks)), \
+                         pool=pool, max_memory_mb=args.max_memory_mb)
+
+        # Stream the log data through read -> filter -> load, each chunk is loaded while the next ones
+        # are parsed, and memory stays bounded on long backfills.
+        # All the chunks are matched against one song index, built once now that the songs are loaded
+        stream_log_data(cur, conn, log_files, log_manifest_df, chunks, pool=pool, \
+                        song_index=build_song_index(cur), max_memory_mb=args.max_memory_mb)
+    else:
+        # Create df of all song data
+        song_df = process_data(cur, conn, filepath='data/song_data', func=process_json_files, \
+                               workers=args.workers, all_files=song_files, cache=cache)
+        loads, checks = [], []
+        if len(song_df) > 0:
+            # Create song and artist dfs, to be streamed into the Postgres tables
+            loads += song_table_loads(*transform_song_data(song_df))
+            # Quality check song and artist tables: Ensure Postgres holds all the song and artist ids
+            # of this batch of song data
+            checks += song_quality_checks(song_df)
+
+        # Create df of all the log data
+        df = process_data(cur, conn, filepath='data/log_data', func=process_json_files, workers=args.workers, \
+                          all_files=log_files, cache=cache)
+        if len(df) > 0:
+            # the watermark of the earlier runs, for the quality checks of the late events
+            watermark = read_watermark(cur)
+            # Filter, convert and sort the NextSong events once, and create the time and user dfs from them,
+            # to be streamed into the Postgres tables
+            events_df, time_df, user_df = transform_log_data(cur, conn, df)
+            # Then match all NextSong events and insert records into the songplay table: the match waits
+            # for the songs and artists of this run to be loaded
+            # Also create a filled songplay table in Postgres with complete artist and song information
+            # Use artist_name and song_name from the log data instead of the ids from the song data
+            # This is because there is only ONE row in the songplays table with NON NULL song_id and artist ids
+            loads += log_table_loads(events_df, time_df, user_df, \
+                                     depends_on=[name for name, func, load_args, deps in loads])
+
+        # Load all the tables concurrently, each table in one transaction on its own connection
+        results = load_tables(pool, loads)
+
+        if len(df) > 0:
+            songplay_df, fill_df = results["songplays"], results["songplays_fill"]
+            # Quality check time, user, songplays and songplays_fill tables: Ensure Postgres holds
+            # all the keys of this batch of log data, and the latest level of each user
+            checks += log_quality_checks(time_df, user_df, songplay_df, fill_df, watermark)
+        quality_check_data(cur, checks)
+
+        # Add the plays loaded since the last refresh to the dashboard rollup tables
+        # (this batch, and the plays of an earlier run that stopped before its refresh)
+        refresh_rollups(cur, conn)
+        if len(df) > 0:
+            update_watermark(cur, conn, time_df)
+        record_manifest(cur, conn, song_manifest_df)
+        record_manifest(cur, conn, log_manifest_df)
+
+    # Retention for the partitioned layout: drop whole months of songplays
+    if args.drop_before:
+        drop_partitions_before(cur, conn, "songplays", args.drop_before)
+        drop_partitions_before(cur, conn, "songplays_fill", args.drop_before)
 
+    pool.closeall()
     conn.close()
+    if args.metrics:
+        metrics.recorder.summary()
+    metrics.recorder.write_profiles()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,75 @@
+import os
+import json
+import pandas as pd
+import metrics
+
+# Finding and parsing the song and log json files, shared by etl.py and parse_cache.py
+# (process_json_files runs in the parser worker processes of etl.py)
+
+# Explicit dtypes of the song and log json fields, so the parsed DFs are compact and typed the same in every file:
+# categoricals for the repetitive text, fixed-width ints, ts as int64 epoch ms and a nullable userId
+# (logged out events have an empty userId). The song artist names and locations are nearly all distinct,
+# so categories would not save memory there and they stay objects
+json_dtypes = {
+    # song data
+    "num_songs": "int32", "artist_id": "object", "artist_latitude": "float64", "artist_longitude": "float64",
+    "artist_location": "object", "artist_name": "object", "song_id": "object", "title": "object",
+    "duration": "float64", "year": "int16",
+    # log data
+    "artist": "category", "auth": "category", "firstName": "category", "gender": "category",
+    "itemInSession": "int32", "lastName": "category", "length": "float64", "level": "category",
+    "location": "category", "method": "category", "page": "category", "registration": "Int64",
+    "sessionId": "int32", "song": "category", "status": "int16", "ts": "int64", "userAgent": "category",
+    "userId": "Int32"}
+# Bump when json_dtypes or process_json_files change, so the parse cache is rebuilt
+json_schema_version = 2
+
+def apply_json_dtypes(df):
+    """Cast the json fields of df to json_dtypes (the fields missing from json_dtypes are left as parsed)"""
+    if 'userId' in df:
+        # userId is a string in the json, and empty for logged out events
+        df['userId'] = pd.to_numeric(df['userId'], errors='coerce')
+    return df.astype({col: dtype for col, dtype in json_dtypes.items() if col in df})
+
+def process_json_files(filepaths):
+    """
+    Read a batch of json files into ONE pandas dataframe as parsed, with the text left as objects
+    (runs in the parser worker processes, one call per batch of files).
+    - Each line is decoded with json.loads and the records of all the files are built into a DF at once,
+    so a tiny file costs a json.loads and not a pd.read_json, and the workers send back one DF per batch
+    - The json_dtypes are applied once to the concatenated DF by concat_frames
+    - Return the DF and the number of rows read from each file (in filepaths order)
+    """
+    records, file_rows = [], []
+    for filepath in filepaths:
+        with open(filepath) as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+        records += rows
+        file_rows.append(len(rows))
+    return pd.DataFrame.from_records(records), file_rows
+
+def parse_json_files(filepaths):
+    """Parse a list of json files in this process into one typed DF (see process_json_files), with the rows of each file"""
+    df, file_rows = process_json_files(filepaths)
+    return concat_frames([df]), file_rows
+
+def concat_frames(frames):
+    """
+    Concatenate the parsed DFs into one DF with a single pd.concat, and only then cast it to the json_dtypes,
+    so the categories are built once per batch (or chunk) instead of once per file and merged
+    """
+    frames = [frame for frame in frames if len(frame.columns) > 0]
+    if not frames:
+        return pd.DataFrame()
+    return apply_json_dtypes(pd.concat(frames, ignore_index=True))
+
+def discover_files(filepath):
+    """Get a sorted list of all json files under filepath in a single directory walk"""
+    with metrics.stage("discover") as record:
+        all_files = []
+        for root, dirs, files in os.walk(filepath):
+            for f in files:
+                if f.endswith('.json'):
+                    all_files.append(os.path.abspath(os.path.join(root, f)))
+        record['rows_out'] = len(all_files)
+    return sorted(all_files)
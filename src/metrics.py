@@ -0,0 +1,255 @@
+import os
+import sys
+import json
+import time
+import threading
+import cProfile
+import tracemalloc
+import datetime
+from contextlib import contextmanager
+import psycopg2.extensions
+try:
+    import resource # peak memory of the process (not available on Windows)
+except ImportError:
+    resource = None
+
+def peak_memory_mb():
+    """Get the peak resident memory of this process in MB (None where the resource module is missing)"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024
+
+def current_memory_mb():
+    """Get the current resident memory of this process in MB (None where /proc is missing, e.g. on macOS)"""
+    try:
+        with open('/proc/self/statm') as f:
+            resident = int(f.read().split()[1]) # in pages
+    except (OSError, IndexError, ValueError):
+        return None
+    return resident * os.sysconf('SC_PAGE_SIZE') / 1024**2
+
+def rss_mb():
+    """Current resident memory in MB, rounded for the records (None where it can't be read)"""
+    memory = current_memory_mb()
+    return None if memory is None else round(memory, 1)
+
+def high_water_mb():
+    """Get the resident memory high-water mark of this process (VmHWM) in MB (None where /proc is missing)"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024 # in kB
+    except (OSError, ValueError):
+        pass
+    return None
+
+def reset_high_water():
+    """Reset VmHWM to the current resident memory (Linux), return False where it can't be reset"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def stage_selected(name, stages):
+    """A stage is selected by its full name (e.g. 'copy songs') or its first word (e.g. 'copy')"""
+    return name in stages or name.split()[0] in stages
+
+class Recorder:
+    """
+    Collects one metrics record per pipeline stage run: wall time, rows in/out, bytes sent,
+    DB round trips and memory.
+    - The memory is the resident memory of the process when the stage starts and ends (rss_start_mb, rss_end_mb),
+    so their difference is what the stage kept allocated, and its high-water mark while the stage ran
+    (rss_peak_mb), so the transient peaks (concat, COPY buffers) are seen too. On Linux the kernel high-water
+    mark (VmHWM) is reset when a stage starts and read when it ends (see fold_peak), elsewhere the memory
+    is sampled by a background thread. It is process wide: it includes stages running on other threads
+    at the same time. The stages in trace_stages also get their own Python peak (py_peak_mb, the Python
+    allocations traced by tracemalloc)
+    - Records are written as JSON lines to output (if set) as soon as each stage ends
+    - Stages named in profile_stages run under cProfile, stages in trace_stages under tracemalloc
+    - Stages can be nested, the round trips and bytes go to the innermost stage of the current thread
+    (so stages running on concurrent loader threads are counted separately)
+    """
+    def __init__(self):
+        self.records = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.profiles = {}
+        self.profiling = False
+        # stages running on any thread, for their memory high-water mark (see fold_peak)
+        self.running = []
+        self.peak_mode = None
+        # highest high-water mark seen, as the resets also lower the ru_maxrss of peak_memory_mb on Linux
+        self.peak_mb = None
+        self.configure()
+
+    @property
+    def active(self):
+        """Stack of the active stages of the current thread"""
+        if not hasattr(self.local, 'active'):
+            self.local.active = []
+        return self.local.active
+
+    def configure(self, output=None, profile_stages=(), trace_stages=()):
+        """Set where the records go, and which stages get profiled or traced"""
+        self.output = output
+        self.profile_stages = set(profile_stages)
+        self.trace_stages = set(trace_stages)
+        self.run = datetime.datetime.now().isoformat(timespec='seconds')
+
+    def fold_peak(self):
+        """
+        Fold the high-water mark since the last reset into the peak of every running stage, then reset it
+        (call with self.lock held). A stage is running over every interval between two resets that
+        overlaps it, so its peak is the highest of these high-water marks
+        """
+        if self.peak_mode is None:
+            # VmHWM where it can be reset, else sampling where the current memory can be read, else no peaks
+            self.peak_mb = high_water_mb()
+            self.peak_mode = 'hwm' if self.peak_mb is not None and reset_high_water() else \
+                             'sample' if current_memory_mb() is not None else 'off'
+            if self.peak_mode == 'sample':
+                threading.Thread(target=self.sample_peaks, name="metrics_sampler", daemon=True).start()
+        if self.peak_mode != 'hwm':
+            return
+        peak = high_water_mb()
+        reset_high_water()
+        if peak is not None:
+            self.peak_mb = max(self.peak_mb or 0, peak)
+            for record in self.running:
+                record["rss_peak_mb"] = round(max(record["rss_peak_mb"] or 0, peak), 1)
+
+    def sample_peaks(self, interval=0.01):
+        """Background thread where VmHWM can't be reset: sample the memory of the running stages every interval s"""
+        while True:
+            memory = current_memory_mb()
+            with self.lock:
+                if memory is not None:
+                    self.peak_mb = max(self.peak_mb or 0, memory)
+                    for record in self.running:
+                        record["rss_peak_mb"] = round(max(record["rss_peak_mb"] or 0, memory), 1)
+            time.sleep(interval)
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        """
+        Context manager around one pipeline stage. Yields the stage record,
+        so the stage can fill in rows_out (e.g. record['rows_out'] = len(df))
+        """
+        record = {"run": self.run, "stage": name, "wall_s": None, "rows_in": rows_in, "rows_out": None, \
+                  "bytes_sent": 0, "round_trips": 0, "rss_start_mb": rss_mb(), "rss_end_mb": None, \
+                  "rss_peak_mb": None, "py_peak_mb": None}
+        profiler = None
+        # only one profiler and one tracemalloc trace can run at a time in the process
+        with self.lock:
+            if stage_selected(name, self.profile_stages) and not self.profiling:
+                profiler = self.profiles.setdefault(name, cProfile.Profile())
+                self.profiling = True
+            trace = stage_selected(name, self.trace_stages) and not tracemalloc.is_tracing()
+            if trace:
+                tracemalloc.start()
+            self.fold_peak()
+            record["rss_peak_mb"] = record["rss_start_mb"]
+            self.running.append(record)
+        self.active.append(record)
+        if profiler is not None:
+            profiler.enable()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["wall_s"] = round(time.perf_counter() - start, 6)
+            self.active.pop()
+            record["rss_end_mb"] = rss_mb()
+            with self.lock:
+                self.fold_peak()
+                self.running.remove(record)
+                if profiler is not None:
+                    profiler.disable()
+                    self.profiling = False
+                if trace:
+                    record["py_peak_mb"] = tracemalloc.get_traced_memory()[1] / 1024**2
+                    tracemalloc.stop()
+                self.records.append(record)
+                if self.output is not None:
+                    with open(self.output, 'a') as f:
+                        f.write(json.dumps(record) + '\n')
+
+    def count(self, nbytes=0):
+        """Count one round trip to Postgres (and the bytes sent) for the innermost active stage"""
+        if self.active:
+            self.active[-1]["round_trips"] += 1
+            self.active[-1]["bytes_sent"] += nbytes
+
+    def summary(self):
+        """
+        Print one line per stage name with the totals over all its runs, the largest memory growth
+        (rss_end_mb - rss_start_mb) of one run and the highest memory peak (rss_peak_mb) of all its runs
+        """
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(record["stage"], {"runs": 0, "wall_s": 0, "rows_in": 0, "rows_out": 0, \
+                                                        "bytes_sent": 0, "round_trips": 0, "rss_growth_mb": None, \
+                                                        "rss_peak_mb": None})
+            total["runs"] += 1
+            for key in ("wall_s", "rows_in", "rows_out", "bytes_sent", "round_trips"):
+                total[key] += record[key] or 0
+            if record["rss_start_mb"] is not None and record["rss_end_mb"] is not None:
+                growth = record["rss_end_mb"] - record["rss_start_mb"]
+                total["rss_growth_mb"] = growth if total["rss_growth_mb"] is None \
+                                         else max(total["rss_growth_mb"], growth)
+            if record["rss_peak_mb"] is not None:
+                total["rss_peak_mb"] = max(total["rss_peak_mb"] or 0, record["rss_peak_mb"])
+        print("{:<28} {:>5} {:>10} {:>10} {:>10} {:>12} {:>8} {:>9} {:>9}".format("stage", "runs", "wall_s", \
+              "rows_in", "rows_out", "bytes_sent", "trips", "+rss_mb", "peak_mb"))
+        for name, total in totals.items():
+            growth = "" if total["rss_growth_mb"] is None else "{:.1f}".format(total["rss_growth_mb"])
+            peak = "" if total["rss_peak_mb"] is None else "{:.1f}".format(total["rss_peak_mb"])
+            print("{:<28} {:>5} {:>10.3f} {:>10} {:>10} {:>12} {:>8} {:>9} {:>9}".format(name, total["runs"], \
+                  total["wall_s"], total["rows_in"], total["rows_out"], total["bytes_sent"], total["round_trips"], \
+                  growth, peak))
+        peak = max([peak for peak in (peak_memory_mb(), self.peak_mb) if peak is not None], default=None)
+        if peak is not None:
+            print("peak RSS: {:.1f} MB".format(peak))
+
+    def write_profiles(self, prefix='profile'):
+        """Dump the cProfile stats of each profiled stage to <prefix>_<stage>.prof"""
+        for name, profiler in self.profiles.items():
+            filename = '{}_{}.prof'.format(prefix, name.replace(' ', '_').replace('/', '_'))
+            profiler.dump_stats(filename)
+            print("cProfile stats for {} written to {}".format(name, filename))
+
+# One recorder for the whole ETL run
+recorder = Recorder()
+
+def stage(name, rows_in=None):
+    """Shortcut for recorder.stage (see Recorder.stage)"""
+    return recorder.stage(name, rows_in)
+
+class MetricsCursor(psycopg2.extensions.cursor):
+    """Cursor that counts the round trips and bytes sent to Postgres for the active stage"""
+    def execute(self, query, vars=None):
+        text = query if isinstance(query, (str, bytes)) else query.as_string(self)
+        recorder.count(len(text))
+        return super().execute(query, vars)
+
+    def copy_expert(self, sql, file, size=8192):
+        result = super().copy_expert(sql, file, size)
+        # the buffer has been read to the end, so its position is the amount of data sent
+        recorder.count(len(sql) + file.tell())
+        return result
+
+class MetricsConnection(psycopg2.extensions.connection):
+    """Connection that hands out MetricsCursors and counts commits as round trips"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = MetricsCursor
+
+    def commit(self):
+        recorder.count()
+        return super().commit()
@@ -0,0 +1,188 @@
+import os
+import json
+import hashlib
+import pandas as pd
+try:
+    import pyarrow as pa # Arrow IPC files for the parse cache (the cache is off without pyarrow)
+except ImportError:
+    pa = None
+import json_files
+
+# On-disk cache of the parsed json files, so reruns (and the notebooks) skip the json decoding.
+# Each cache file is an Arrow IPC (Feather v2) file holding the typed DF of one batch of parsed json files,
+# concatenated (the categoricals as Arrow dictionaries), with the fingerprint (path, size, mtime) and the number
+# of rows of each json file in the schema metadata, and the version of the parser.
+# - The rows of a json file are read back as a zero-copy slice of the memory map of the cache file holding
+# its current fingerprint, the slices of all the files asked for are turned into ONE DF at the end
+# - A cache file holding a json file that changed or no longer exists is deleted (its other json files
+# are parsed again, and cached, the next time they are read)
+default_cache_dir = 'data/parse_cache'
+
+def fingerprint(filepath, version=None):
+    """Get the fingerprint of a json file: its absolute path, size and mtime (in ns), and the parser version"""
+    stat = os.stat(filepath)
+    return {"path": os.path.abspath(filepath), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, \
+            "version": version}
+
+def arrow_schema(df):
+    """
+    Get the Arrow schema of a typed DF, with the same types in every cache file so their tables can be
+    concatenated: string dictionaries with int32 indices for the categoricals, strings for the all-null columns
+    """
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    fields = []
+    for field in schema:
+        if pa.types.is_dictionary(field.type):
+            field = field.with_type(pa.dictionary(pa.int32(), pa.string()))
+        elif pa.types.is_null(field.type):
+            field = field.with_type(pa.string())
+        fields.append(field)
+    return pa.schema(fields, metadata=schema.metadata)
+
+def read_cache_file(path):
+    """Read the table of a cache file from a memory map, and the fingerprints of its json files (None if unreadable)"""
+    try:
+        with pa.memory_map(path) as source:
+            table = pa.ipc.open_file(source).read_all()
+        return table, json.loads(table.schema.metadata[b'sparkify_files'])
+    except (OSError, KeyError, ValueError, pa.ArrowInvalid):
+        return None # e.g. a truncated cache file, or a cache file of an older layout
+
+def write_cache_file(cachedir, keys, df):
+    """
+    Write the typed DF of a batch of json files to a new cache file, with the fingerprints (keys, plus the rows
+    of each file) in the Arrow schema metadata. Return the path and the Arrow table (None if the DF can't be
+    stored in Arrow, e.g. a column mixing numbers and strings: the batch is just not cached).
+    The file is written under a temp name and renamed, so readers never see a partial cache file
+    """
+    try:
+        table = pa.Table.from_pandas(df, schema=arrow_schema(df), preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return None, None
+    metadata = dict(table.schema.metadata or {})
+    metadata[b'sparkify_files'] = json.dumps(keys).encode()
+    table = table.replace_schema_metadata(metadata)
+    os.makedirs(cachedir, exist_ok=True)
+    path = os.path.join(cachedir, hashlib.sha1(json.dumps(keys).encode()).hexdigest() + '.arrow')
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+    return path, table
+
+def without_rows(key):
+    """The fingerprint part of a cached key (see fingerprint), without the rows of the json file"""
+    return {name: value for name, value in key.items() if name != 'rows'}
+
+class ParseCache:
+    """
+    Parse cache in cachedir (see the top of this file).
+    version changes when the parsed DFs change (e.g. their dtypes), so the cache files of older versions are deleted.
+    The cache files are indexed on first use: the index maps each cached json file to its fingerprint,
+    cache file, row offset and rows (see scan)
+    """
+    def __init__(self, cachedir=default_cache_dir, version=None):
+        self.cachedir = cachedir
+        self.version = version
+        self.index = None
+        self.tables = {}
+        self.fingerprints = {}
+
+    def fingerprint(self, filepath):
+        """Fingerprint of a json file, taken once per run (the files are fingerprinted by scan, then by load)"""
+        if filepath not in self.fingerprints:
+            self.fingerprints[filepath] = fingerprint(filepath, self.version)
+        return self.fingerprints[filepath]
+
+    def is_current(self, key):
+        """Check that a fingerprint still matches its json file (which must still exist)"""
+        try:
+            return self.fingerprint(key['path']) == key
+        except OSError:
+            return False
+
+    def scan(self):
+        """
+        Index the json files of the cache files (once), and delete the stale cache files:
+        unreadable, of another version, or holding a json file that changed or no longer exists
+        """
+        if self.index is not None:
+            return
+        self.index = {}
+        if not os.path.isdir(self.cachedir):
+            return
+        for name in sorted(os.listdir(self.cachedir)):
+            if not name.endswith('.arrow'):
+                continue
+            path = os.path.join(self.cachedir, name)
+            cached = read_cache_file(path)
+            if cached is None or not all(self.is_current(without_rows(key)) for key in cached[1]):
+                os.remove(path)
+                continue
+            self.add(path, *cached)
+
+    def add(self, path, table, keys):
+        """Index the json files of a cache file: their fingerprint, row offset in its table and rows"""
+        self.tables[path] = table
+        offset = 0
+        for key in keys:
+            self.index[key['path']] = (without_rows(key), path, offset, key['rows'])
+            offset += key['rows']
+
+    def load(self, all_files, parse):
+        """
+        Get the typed DF of all_files (rows in all_files order, like parse).
+        - The files indexed with their current fingerprint are sliced out of their cache file
+        - The other files are parsed with parse(files), which returns their typed DF and the rows of each file,
+        in ONE call, and written to a new cache file
+        """
+        self.scan()
+        keys = [self.fingerprint(os.path.abspath(filepath)) for filepath in all_files]
+        missing = [key for key in keys if self.index.get(key['path'], (None,))[0] != key]
+        if missing:
+            df, file_rows = parse([key['path'] for key in missing])
+            missing = [dict(key, rows=num_rows) for key, num_rows in zip(missing, file_rows)]
+            path, table = write_cache_file(self.cachedir, missing, df)
+            if path is None:
+                # the batch can't be cached: return it as parsed (with the cached files parsed again,
+                # to keep the file order)
+                return df if len(missing) == len(keys) else parse(all_files)[0]
+            self.add(path, table, missing)
+            if len(missing) == len(keys):
+                return df
+        # zero-copy slices of the memory mapped tables (one slice per run of files stored one after the other),
+        # concatenated and turned into one DF
+        runs = []
+        for key in keys:
+            cached_key, path, offset, num_rows = self.index[key['path']]
+            if runs and runs[-1][0] == path and runs[-1][1] + runs[-1][2] == offset:
+                runs[-1][2] += num_rows
+            else:
+                runs.append([path, offset, num_rows])
+        slices = [self.tables[path].slice(offset, num_rows) for path, offset, num_rows in runs]
+        columns = slices[0].column_names
+        return pa.concat_tables([piece.select(columns) for piece in slices]).to_pandas()
+
+def open_cache(cachedir=default_cache_dir, version=None):
+    """Get the parse cache in cachedir (None if cachedir is None or pyarrow is missing, the cache is then off)"""
+    if cachedir is None:
+        return None
+    if pa is None:
+        print('pyarrow is not installed, the parse cache is off')
+        return None
+    return ParseCache(cachedir, version)
+
+def load_parsed(filepath, cachedir=default_cache_dir):
+    """
+    Load all the json files under filepath into one typed pandas DF from the parse cache
+    (e.g. in the notebooks: df_log = load_parsed('data/log_data')).
+    The files missing from the cache, or changed since they were cached, are parsed like etl.py does and cached
+    """
+    all_files = json_files.discover_files(filepath)
+    if not all_files:
+        return pd.DataFrame()
+    cache = open_cache(cachedir, json_files.json_schema_version)
+    if cache is None:
+        return json_files.parse_json_files(all_files)[0]
+    return cache.load(all_files, json_files.parse_json_files)
@@ -4,10 +4,6 @@
 dbstring = "host=127.0.0.1 dbname=sparkifydb user=student password=student" # for Udacity server
 dbstring_default = "host=127.0.0.1 dbname=studentdb user=student password=student" # for Udacity server
 
-# Set data paths for efficient loading using COPY
-#datapath = r'C:/Users/ericr/Google Drive/Online Courses/Udacity/Data Engineering/Part 1 - Data Modeling/data-modeling-postgres/data'
-datapath = "/home/workspace/data" # for Udacity server
-
 # DROP TABLES
 
 songplay_table_drop = "DROP TABLE IF EXISTS songplays"
@@ -16,6 +12,11 @@ user_table_drop = "DROP TABLE IF EXISTS users"
 song_table_drop = "DROP TABLE IF EXISTS songs"
 artist_table_drop = "DROP TABLE IF EXISTS artists"
 time_table_drop = "DROP TABLE IF EXISTS time"
+manifest_table_drop = "DROP TABLE IF EXISTS etl_manifest"
+watermark_table_drop = "DROP TABLE IF EXISTS etl_watermark"
+rollup_table_drops = ["DROP TABLE IF EXISTS rollup_artist_plays", "DROP TABLE IF EXISTS rollup_matched_artist_plays", \
+                      "DROP TABLE IF EXISTS rollup_song_plays", "DROP TABLE IF EXISTS rollup_user_plays", \
+                      "DROP TABLE IF EXISTS rollup_hour_weekday_plays"]
 
 # CREATE TABLES
 # Using PRIMARY KEY prevent duplicate rows
@@ -23,6 +24,9 @@ time_table_drop = "DROP TABLE IF EXISTS time"
 # (some columns have nulls, such as song_id, artist_id, location, latitude)
 
 # songplay_id as SERIAL (autogenerated by computer)
+# etl.py numbers the songplay ids of each load, so a rerun of the same events gets new ids.
+# The natural key (one play per user session at a start_time) makes such a rerun a no-op:
+# the events already loaded hit the key and are skipped by ON CONFLICT DO NOTHING
 songplay_table_create = ("""CREATE TABLE IF NOT EXISTS songplays (songplay_id SERIAL PRIMARY KEY, \
                                                                 start_time timestamp NOT NULL, \
                                                                 user_id int NOT NULL, \
@@ -31,7 +35,9 @@ songplay_table_create = ("""CREATE TABLE IF NOT EXISTS songplays (songplay_id SE
                                                                 artist_id varchar, \
                                                                 session_id int NOT NULL, \
                                                                 location varchar, \
-                                                                user_agent varchar);""")
+                                                                user_agent varchar, \
+                                                                CONSTRAINT songplays_event_key \
+                                                                UNIQUE (start_time, user_id, session_id));""")
 
 # Use song name and artist name instead, so we can do some basic user songplay analysis
 # Because all but 1 row of the songplays table are NULL for artist_id and song_id
@@ -43,7 +49,9 @@ songplay_table_create_2 = ("""CREATE TABLE IF NOT EXISTS songplays_fill (songpla
                                                                 artist_name varchar, \
                                                                 session_id int NOT NULL, \
                                                                 location varchar, \
-                                                                user_agent varchar);""")
+                                                                user_agent varchar, \
+                                                                CONSTRAINT songplays_fill_event_key \
+                                                                UNIQUE (start_time, user_id, session_id));""")
 
 user_table_create = ("""CREATE TABLE IF NOT EXISTS users (user_id int NOT NULL PRIMARY KEY, \
                                                         first_name varchar, \
@@ -70,18 +78,154 @@ time_table_create = ("""CREATE TABLE IF NOT EXISTS time (start_time timestamp NO
                                                        month int, \
                                                        year int NOT NULL, \
                                                        weekday int NOT NULL);""")
+
+# PARTITIONED LAYOUT (create_tables.py --partitioned)
+# The songplays tables are split into monthly range partitions on start_time, which etl.py creates as needed.
+# Time bounded queries only scan the matching partitions, and old months can be dropped partition by partition.
+# The primary and natural keys of a partitioned table must include the partition column
+songplay_table_create_partitioned = ("""CREATE TABLE IF NOT EXISTS songplays (songplay_id SERIAL, \
+                                                                start_time timestamp NOT NULL, \
+                                                                user_id int NOT NULL, \
+                                                                level varchar, \
+                                                                song_id varchar, \
+                                                                artist_id varchar, \
+                                                                session_id int NOT NULL, \
+                                                                location varchar, \
+                                                                user_agent varchar, \
+                                                                PRIMARY KEY (songplay_id, start_time), \
+                                                                CONSTRAINT songplays_event_key \
+                                                                UNIQUE (start_time, user_id, session_id)) \
+                                                                PARTITION BY RANGE (start_time);""")
+
+songplay_table_create_2_partitioned = ("""CREATE TABLE IF NOT EXISTS songplays_fill (songplay_id SERIAL, \
+                                                                start_time timestamp NOT NULL, \
+                                                                user_id int NOT NULL, \
+                                                                level varchar, \
+                                                                song_name varchar, \
+                                                                artist_name varchar, \
+                                                                session_id int NOT NULL, \
+                                                                location varchar, \
+                                                                user_agent varchar, \
+                                                                PRIMARY KEY (songplay_id, start_time), \
+                                                                CONSTRAINT songplays_fill_event_key \
+                                                                UNIQUE (start_time, user_id, session_id)) \
+                                                                PARTITION BY RANGE (start_time);""")
+
+# Indexes created on the partitioned tables are added to every partition, including the ones created later.
+# BRIN for start_time (rows are loaded in start_time order, so it stays tiny), B-tree for the lookup columns
+songplay_index_create = ["""CREATE INDEX IF NOT EXISTS songplays_start_time_idx ON songplays USING brin (start_time);""",
+                         """CREATE INDEX IF NOT EXISTS songplays_user_id_idx ON songplays (user_id);""",
+                         """CREATE INDEX IF NOT EXISTS songplays_song_id_idx ON songplays (song_id);""",
+                         """CREATE INDEX IF NOT EXISTS songplays_artist_id_idx ON songplays (artist_id);"""]
+
+songplay_index_create_2 = ["""CREATE INDEX IF NOT EXISTS songplays_fill_start_time_idx ON songplays_fill \
+                              USING brin (start_time);""",
+                           """CREATE INDEX IF NOT EXISTS songplays_fill_user_id_idx ON songplays_fill (user_id);""",
+                           """CREATE INDEX IF NOT EXISTS songplays_fill_song_name_idx ON songplays_fill (song_name);""",
+                           """CREATE INDEX IF NOT EXISTS songplays_fill_artist_name_idx ON songplays_fill \
+                              (artist_name);"""]
+
+# Monthly partitions: the partition and table names are filled in with sql.Identifier, the bounds with sql.Literal
+partition_create = ("""CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES FROM ({}) TO ({});""")
+
+partitioned_select = ("""SELECT EXISTS (SELECT 1 FROM pg_partitioned_table p \
+                       JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = %s);""")
+
+partition_select = ("""SELECT c.relname FROM pg_inherits i \
+                     JOIN pg_class c ON c.oid = i.inhrelid \
+                     JOIN pg_class p ON p.oid = i.inhparent \
+                     WHERE p.relname = %s;""")
+
+# BULK LOAD MODE (create_tables.py --bulk-load)
+# For initial loads and full rebuilds, the star schema tables start UNLOGGED and without their primary keys,
+# so their first load is a plain COPY: no temp table is staged and no index is maintained row by row.
+# etl.py then dedupes the table in one set-based pass, builds the primary key and switches the table to LOGGED,
+# in the same transaction as the COPY. Later loads go through the usual staged upserts.
+# NOTE: SET LOGGED rewrites the table, and writes all of it to WAL when wal_level is above minimal
+# (e.g. with replication), so the WAL volume is about the same as a logged load: the gain is skipping
+# the per-row index maintenance and the temp table staging, not the WAL.
+# Primary key columns of the tables that can be bulk loaded (partitioned tables can't be UNLOGGED)
+bulk_load_keys = {"songplays": "songplay_id", "users": "user_id", "songs": "song_id", "artists": "artist_id", \
+                  "time": "start_time", "songplays_fill": "songplay_id"}
+# Natural key constraints (name and columns) of the songplays tables, dropped and built back like the primary keys
+bulk_load_unique_keys = {"songplays": ("songplays_event_key", ("start_time", "user_id", "session_id")), \
+                         "songplays_fill": ("songplays_fill_event_key", ("start_time", "user_id", "session_id"))}
+
+# The table, constraint and key names are filled in with sql.Identifier in create_tables.py and etl.py
+bulk_table_prepare = ("""ALTER TABLE {} DROP CONSTRAINT {}, SET UNLOGGED;""")
+
+bulk_table_drop_unique = ("""ALTER TABLE {} DROP CONSTRAINT {};""")
+
+bulk_table_select = ("""SELECT EXISTS (SELECT 1 FROM pg_class WHERE relname = %s AND relpersistence = 'u');""")
+
+bulk_table_copy = ("""COPY {} FROM STDIN WITH CSV;""")
+
+# Keep the first row loaded for each key, like ON CONFLICT DO NOTHING
+# (the user rows are deduped to the latest level in etl.py before the COPY)
+# (a_key and b_key list the key columns of a and b, so this also works for the natural keys)
+bulk_table_dedupe = ("""DELETE FROM {table} a USING {table} b \
+                      WHERE ({a_key}) = ({b_key}) AND a.ctid > b.ctid;""")
+
+bulk_table_add_unique = ("""ALTER TABLE {} ADD CONSTRAINT {} UNIQUE ({});""")
+
+bulk_table_finish = ("""ALTER TABLE {} ADD PRIMARY KEY ({}), SET LOGGED;""")
+
+# Bookkeeping tables for incremental ETL runs (etl.py --incremental)
+# etl_manifest records every json file that was loaded, so unchanged files are not parsed again
+manifest_table_create = ("""CREATE TABLE IF NOT EXISTS etl_manifest (filepath varchar NOT NULL PRIMARY KEY, \
+                                                                   size bigint NOT NULL, \
+                                                                   mtime double precision NOT NULL, \
+                                                                   content_hash varchar NOT NULL, \
+                                                                   loaded_at timestamp NOT NULL);""")
+
+# etl_watermark holds the latest songplay start_time loaded so far (the 'songplays' row),
+# and the last songplay_id of each songplays table added to the rollup tables (the 'rollup_<table>' rows)
+watermark_table_create = ("""CREATE TABLE IF NOT EXISTS etl_watermark (name varchar NOT NULL PRIMARY KEY, \
+                                                                     start_time timestamp, \
+                                                                     songplay_id bigint);""")
+
+# ROLLUP TABLES for the analytic dashboard (see analytics.py)
+# Play counts that etl.py updates from the songplays of each load only (never a full scan of the fact tables).
+# NOTE: they hold lifetime totals, so they keep counting months dropped with --drop-before
+rollup_table_creates = ["""CREATE TABLE IF NOT EXISTS rollup_artist_plays (artist_name varchar NOT NULL, \
+                                                                         level varchar NOT NULL, \
+                                                                         num_plays bigint NOT NULL, \
+                                                                         PRIMARY KEY (artist_name, level));""",
+                        """CREATE TABLE IF NOT EXISTS rollup_matched_artist_plays (artist_id varchar NOT NULL PRIMARY KEY, \
+                                                                                 num_plays bigint NOT NULL);""",
+                        """CREATE TABLE IF NOT EXISTS rollup_song_plays (song_name varchar NOT NULL, \
+                                                                       artist_name varchar NOT NULL, \
+                                                                       num_plays bigint NOT NULL, \
+                                                                       PRIMARY KEY (song_name, artist_name));""",
+                        """CREATE TABLE IF NOT EXISTS rollup_user_plays (user_id int NOT NULL, \
+                                                                       level varchar NOT NULL, \
+                                                                       num_plays bigint NOT NULL, \
+                                                                       PRIMARY KEY (user_id, level));""",
+                        """CREATE TABLE IF NOT EXISTS rollup_hour_weekday_plays (hour int NOT NULL, \
+                                                                               weekday int NOT NULL, \
+                                                                               num_plays bigint NOT NULL, \
+                                                                               PRIMARY KEY (hour, weekday));"""]
+
 # INSERT RECORDS
-# NOTE: using INSERT INTO for the songplays table because I feel it makes more sense 
-# to loop through the log file df ONLY BECAUSE of the join required for each NextSong event.
-# Please let me know if there is a more efficient way to do this
+# NOTE: songplays used to be inserted row by row, with a song_select lookup for each NextSong event.
+# The songs/artists are now loaded once into an in-memory match index (see song_index_select below),
+# so the songplays rows can be matched in Python and loaded with a single COPY like the other tables
+# ON CONFLICT without a column list, so it also works with the (songplay_id, start_time) key of the partitioned layout
+songplay_table_insert = ("""INSERT INTO songplays \
+                     SELECT * FROM tmp_table \
+                     ON CONFLICT DO NOTHING;""")
 
-songplay_table_insert = ("""INSERT INTO songplays (start_time, user_id, level, song_id, artist_id, session_id, \
-                                                 location, user_agent) VALUES (%s, %s, %s, %s, %s, %s, %s, %s) \
-                                                 ON CONFLICT (songplay_id) DO NOTHING;""")
 # Procedure for COPY:
-# First, create a temp table, and COPY the entire CSV file into the temp table
+# First, create a temp table, and stream the rows into it with COPY FROM STDIN (no CSV files on the server)
 # Then, use INSERT to transfer all data from the temp table to the final table (songs, users, time, artists, or songplays)
 # Finally, ON CONFLICT (PRIMARY_KEY) DO NOTHING to ensure the transactions skip over duplicate primary keys!
+# The temp table name is filled in with sql.Identifier in etl.py
+tmp_table_create = ("""CREATE TEMP TABLE tmp_table ON COMMIT DROP \
+                      AS \
+                      SELECT * FROM {} WITH NO DATA;""")
+
+# Rows are sent from the client as CSV chunks, so this works against a remote Postgres server too
+tmp_table_copy = ("""COPY tmp_table FROM STDIN WITH CSV;""")
 
 # OLD USERS INSERT - keeping this for reference only. Changed to below from reviewer comment
 # For users table, need to first delete rows with duplicate user ids keeping the most recent row 
@@ -99,57 +243,184 @@ songplay_table_insert = ("""INSERT INTO songplays (start_time, user_id, level, s
 #                      SELECT * FROM tmp_table \
 #                      ON CONFLICT (user_id) DO UPDATE SET level = EXCLUDED.level;""")
 
-# Updated users table insert. No more COPY statement, and proper level DO UPDATE
-# NOTE: this runs noticably slower than the old statement above. But I have this in because of reviewer comment
-user_table_insert = ("""INSERT INTO users (user_id, first_name, last_name, gender, level) \
-                    VALUES (%s, %s, %s, %s, %s) \
-                    ON CONFLICT (user_id) DO UPDATE SET level=EXCLUDED.level""")
+# Updated users table insert, with proper level DO UPDATE (from reviewer comment).
+# The rows are deduped in etl.py to the most recent row per userId (ordered by ts) BEFORE the COPY,
+# so the whole batch goes in with one staged statement and the latest level wins
+user_table_insert = ("""INSERT INTO users \
+                    SELECT * FROM tmp_table \
+                    ON CONFLICT (user_id) DO UPDATE SET level=EXCLUDED.level;""")
 
 # Reviewer suggested using INSERT INTO instead of COPY for the remaining tables.
 # I would rather keep the COPY statements, since that was a suggestion to make 
 # our projects stand out
-song_table_insert = ("""CREATE TEMP TABLE tmp_table ON COMMIT DROP \
-                      AS \
-                      SELECT * FROM songs WITH NO DATA;""" \
-                     """COPY tmp_table FROM %s DELIMITERS ',' CSV HEADER;""" \
-                     """INSERT INTO songs \
+song_table_insert = ("""INSERT INTO songs \
                      SELECT * FROM tmp_table \
                      ON CONFLICT (song_id) DO NOTHING;""")
 
-artist_table_insert = ("""CREATE TEMP TABLE tmp_table ON COMMIT DROP \
-                      AS \
-                      SELECT * FROM artists WITH NO DATA;""" \
-                     """COPY tmp_table FROM %s DELIMITERS ',' CSV HEADER;""" \
-                     """INSERT INTO artists \
+artist_table_insert = ("""INSERT INTO artists \
                      SELECT * FROM tmp_table \
                      ON CONFLICT (artist_id) DO NOTHING;""")
 
-time_table_insert = ("""CREATE TEMP TABLE tmp_table ON COMMIT DROP \
-                      AS \
-                      SELECT * FROM time WITH NO DATA;""" \
-                     """COPY tmp_table FROM %s DELIMITERS ',' CSV HEADER;""" \
-                     """INSERT INTO time \
+time_table_insert = ("""INSERT INTO time \
                      SELECT * FROM tmp_table \
                      ON CONFLICT (start_time) DO NOTHING;""")
 
-songplay_table_insert_2 = ("""CREATE TEMP TABLE tmp_table ON COMMIT DROP \
-                      AS \
-                      SELECT * FROM songplays_fill WITH NO DATA;""" \
-                     """COPY tmp_table FROM %s DELIMITERS ',' CSV HEADER;""" \
-                     """INSERT INTO songplays_fill \
+songplay_table_insert_2 = ("""INSERT INTO songplays_fill \
                      SELECT * FROM tmp_table \
-                     ON CONFLICT (songplay_id) DO NOTHING;""")
+                     ON CONFLICT DO NOTHING;""")
+
+# INCREMENTAL LOADS
+
+manifest_select = ("""SELECT filepath, size, mtime, content_hash FROM etl_manifest;""")
+
+manifest_insert = ("""INSERT INTO etl_manifest \
+                     SELECT * FROM tmp_table \
+                     ON CONFLICT (filepath) DO UPDATE SET size=EXCLUDED.size, mtime=EXCLUDED.mtime, \
+                     content_hash=EXCLUDED.content_hash, loaded_at=EXCLUDED.loaded_at;""")
+
+watermark_select = ("""SELECT start_time FROM etl_watermark WHERE name = 'songplays';""")
+
+# Only move the watermark forward
+watermark_insert = ("""INSERT INTO etl_watermark (name, start_time) VALUES ('songplays', %s) \
+                     ON CONFLICT (name) DO UPDATE SET start_time = GREATEST(etl_watermark.start_time, EXCLUDED.start_time);""")
+
+# Songplay ids continue from the highest id already loaded (the table name is filled in with sql.Identifier)
+songplay_max_id_select = ("""SELECT MAX(songplay_id) FROM {};""")
+
+# ROLLUP REFRESH
+# Add the plays loaded since the last refresh (the songplay ids after the rollup watermark of each table,
+# up to the highest id loaded) to the rollup tables, then move the watermarks, all in one transaction.
+# weekday is Monday=0, like the time table
+rollup_watermark_select = ("""SELECT name, songplay_id FROM etl_watermark \
+                            WHERE name IN ('rollup_songplays', 'rollup_songplays_fill') FOR UPDATE;""")
+
+rollup_watermark_insert = ("""INSERT INTO etl_watermark (name, songplay_id) VALUES (%s, %s) \
+                            ON CONFLICT (name) DO UPDATE SET songplay_id = EXCLUDED.songplay_id;""")
+
+rollup_refresh_queries = ["""INSERT INTO rollup_artist_plays \
+                          SELECT artist_name, level, COUNT(*) FROM songplays_fill \
+                          WHERE songplay_id > %(fill_from)s AND songplay_id <= %(fill_to)s \
+                          AND artist_name IS NOT NULL AND level IS NOT NULL \
+                          GROUP BY 1, 2 \
+                          ON CONFLICT (artist_name, level) \
+                          DO UPDATE SET num_plays = rollup_artist_plays.num_plays + EXCLUDED.num_plays;""",
+                          """INSERT INTO rollup_matched_artist_plays \
+                          SELECT artist_id, COUNT(*) FROM songplays \
+                          WHERE songplay_id > %(songplay_from)s AND songplay_id <= %(songplay_to)s \
+                          AND artist_id IS NOT NULL \
+                          GROUP BY 1 \
+                          ON CONFLICT (artist_id) \
+                          DO UPDATE SET num_plays = rollup_matched_artist_plays.num_plays + EXCLUDED.num_plays;""",
+                          """INSERT INTO rollup_song_plays \
+                          SELECT song_name, artist_name, COUNT(*) FROM songplays_fill \
+                          WHERE songplay_id > %(fill_from)s AND songplay_id <= %(fill_to)s \
+                          AND song_name IS NOT NULL AND artist_name IS NOT NULL \
+                          GROUP BY 1, 2 \
+                          ON CONFLICT (song_name, artist_name) \
+                          DO UPDATE SET num_plays = rollup_song_plays.num_plays + EXCLUDED.num_plays;""",
+                          """INSERT INTO rollup_user_plays \
+                          SELECT user_id, level, COUNT(*) FROM songplays_fill \
+                          WHERE songplay_id > %(fill_from)s AND songplay_id <= %(fill_to)s AND level IS NOT NULL \
+                          GROUP BY 1, 2 \
+                          ON CONFLICT (user_id, level) \
+                          DO UPDATE SET num_plays = rollup_user_plays.num_plays + EXCLUDED.num_plays;""",
+                          """INSERT INTO rollup_hour_weekday_plays \
+                          SELECT EXTRACT(HOUR FROM start_time)::int, EXTRACT(ISODOW FROM start_time)::int - 1, \
+                          COUNT(*) FROM songplays_fill \
+                          WHERE songplay_id > %(fill_from)s AND songplay_id <= %(fill_to)s \
+                          GROUP BY 1, 2 \
+                          ON CONFLICT (hour, weekday) \
+                          DO UPDATE SET num_plays = rollup_hour_weekday_plays.num_plays + EXCLUDED.num_plays;"""]
+
+# DASHBOARD QUERIES (served from the rollup tables, see analytics.py)
+
+top_artists_select = ("""SELECT artist_name, SUM(num_plays)::bigint AS num_plays FROM rollup_artist_plays \
+                       GROUP BY 1 ORDER BY 2 DESC LIMIT %s;""")
+
+top_artists_level_select = ("""SELECT artist_name, num_plays FROM rollup_artist_plays \
+                             WHERE level = %s ORDER BY 2 DESC LIMIT %s;""")
+
+top_matched_artists_select = ("""SELECT a.name AS artist_name, SUM(r.num_plays)::bigint AS num_plays \
+                               FROM rollup_matched_artist_plays r JOIN artists a ON r.artist_id = a.artist_id \
+                               GROUP BY 1 ORDER BY 2 DESC LIMIT %s;""")
+
+top_songs_select = ("""SELECT song_name, artist_name, num_plays FROM rollup_song_plays \
+                     ORDER BY 3 DESC LIMIT %s;""")
+
+user_plays_select = ("""SELECT user_id, level, num_plays FROM rollup_user_plays \
+                      ORDER BY 1, 2;""")
+
+hour_weekday_plays_select = ("""SELECT hour, weekday, num_plays FROM rollup_hour_weekday_plays \
+                              ORDER BY 1, 2;""")
+
+# DATA QUALITY CHECKS
+# Each query returns the keys that Postgres holds for the batch just loaded:
+# - songs, artists and users are looked up by the batch keys (users must also have the latest level of the batch)
+# - time and songplays are scoped to the start_time range of the batch, so no key lists are sent for the big tables.
+# The songplays keys are their natural keys (start_time in epoch ms/user_id/session_id): the songplay ids are
+# numbered by each load, so only the natural keys show an event loaded twice (or missing) in the batch range
+# etl.py wraps them with check_select and sends all the checks of a batch with UNION ALL in one query
+
+song_check_keys = ("""SELECT song_id FROM songs WHERE song_id = ANY(%(song_ids)s)""")
+
+artist_check_keys = ("""SELECT artist_id FROM artists WHERE artist_id = ANY(%(artist_ids)s)""")
+
+user_check_keys = ("""SELECT u.user_id FROM users u \
+                    JOIN unnest(%(user_ids)s::int[], %(levels)s::varchar[]) AS b (user_id, level) \
+                    ON u.user_id = b.user_id AND u.level = b.level""")
+
+# The time and songplays keys of the batch range after the watermark (time_after, NULL before the first load),
+# plus the keys of the late events at or before it (late_*), which are looked up one by one
+time_check_keys = ("""SELECT ROUND(EXTRACT(EPOCH FROM start_time) * 1000)::bigint FROM time \
+                    WHERE start_time BETWEEN %(time_first)s AND %(time_last)s \
+                    AND (%(time_after)s::timestamp IS NULL OR start_time > %(time_after)s) \
+                    UNION ALL \
+                    SELECT ROUND(EXTRACT(EPOCH FROM start_time) * 1000)::bigint FROM time \
+                    WHERE start_time = ANY(%(late_times)s::timestamp[])""")
+
+songplay_check_keys = ("""SELECT ROUND(EXTRACT(EPOCH FROM s.start_time) * 1000)::bigint || '/' || s.user_id \
+                        || '/' || s.session_id FROM songplays s \
+                        WHERE s.start_time BETWEEN %(time_first)s AND %(time_last)s \
+                        AND (%(time_after)s::timestamp IS NULL OR s.start_time > %(time_after)s) \
+                        UNION ALL \
+                        SELECT ROUND(EXTRACT(EPOCH FROM s.start_time) * 1000)::bigint || '/' || s.user_id \
+                        || '/' || s.session_id FROM songplays s \
+                        JOIN unnest(%(late_start_times)s::timestamp[], %(late_user_ids)s::int[], \
+                                    %(late_session_ids)s::int[]) AS b (start_time, user_id, session_id) \
+                        ON s.start_time = b.start_time AND s.user_id = b.user_id AND s.session_id = b.session_id""")
+
+songplay_check_keys_2 = ("""SELECT ROUND(EXTRACT(EPOCH FROM s.start_time) * 1000)::bigint || '/' || s.user_id \
+                          || '/' || s.session_id FROM songplays_fill s \
+                          WHERE s.start_time BETWEEN %(time_first)s AND %(time_last)s \
+                          AND (%(time_after)s::timestamp IS NULL OR s.start_time > %(time_after)s) \
+                          UNION ALL \
+                          SELECT ROUND(EXTRACT(EPOCH FROM s.start_time) * 1000)::bigint || '/' || s.user_id \
+                          || '/' || s.session_id FROM songplays_fill s \
+                          JOIN unnest(%(late_start_times)s::timestamp[], %(late_user_ids)s::int[], \
+                                      %(late_session_ids)s::int[]) AS b (start_time, user_id, session_id) \
+                          ON s.start_time = b.start_time AND s.user_id = b.user_id AND s.session_id = b.session_id""")
+
+# Row count and key checksum of one check (the keys query and checksum expression are filled in etl.py)
+check_select = ("""SELECT {} AS tablename, COUNT(*) AS num_rows, {} AS checksum FROM ({}) AS batch (k)""")
+
+# Key checksums: the sum of numeric keys, or the sum of the first 60 bits of the md5 of text keys
+check_sum = ("""SUM(k)""")
+
+check_md5_sum = ("""SUM(('x' || LEFT(MD5(k), 15))::bit(60)::bigint)""")
 
 # FIND SONGS
+# Fetch every song with its artist name ONCE, to build the (title, artist name, duration) match index
 
-song_select = ("""SELECT s.song_id, a.artist_id \
+song_index_select = ("""SELECT s.title, a.name, s.duration, s.song_id, a.artist_id \
                 FROM songs s JOIN artists a \
-                ON s.artist_id = a.artist_id \
-                WHERE s.title = %s AND a.name = %s AND s.duration = %s;""")
+                ON s.artist_id = a.artist_id;""")
 
 # QUERY LISTS
 
 create_table_queries = [songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create, \
-                       songplay_table_create_2]
+                       songplay_table_create_2, manifest_table_create, watermark_table_create] + rollup_table_creates
 drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, \
-                     songplay_table_drop_2]
\ No newline at end of file
+                     songplay_table_drop_2, manifest_table_drop, watermark_table_drop] + rollup_table_drops
+# create_tables.py --partitioned uses these instead of songplay_table_create and songplay_table_create_2
+partitioned_table_queries = [songplay_table_create_partitioned, songplay_table_create_2_partitioned] + \
+                            songplay_index_create + songplay_index_create_2
\ No newline at end of file